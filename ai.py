@@ -3,17 +3,9 @@
 from collections import deque
 from random import choice
 
-from loguru import logger
-
 from common import FIREACTION, MOVEACTION, BoardState, Enemy, Player
-
-logger.remove()
-logger.add("run.log",
-           format="{time}:{level}:{line}:{function}:{message}",
-           level="INFO")
-#  logger.add(sys.stderr,
-#  format="{time}:{level}:{line}:{function}:{message}",
-#  level="INFO")
+from log import slog
+from metrics import timed
 
 ACTION_TO_PRIORITY = {
     MOVEACTION.UP: 10,
@@ -56,19 +48,37 @@ class Stratey:
 
     def best_action(self):
         best = ""
-        self.env.update_from_action(best)
         return best
 
 
 class RandomStrategy(Stratey):
     def best_action(self):
         best = choice(Stratey.ALL_ACTIONS)
-        self.env.update_from_action(best)
         return str(best)
 
 
 class RewardMaxStrategy(Stratey):
-    @logger.catch
+    # board engines used by traversals, see `bitboard.py` and `incremental.py`
+    ENGINES = ("python", "bitboard", "incremental")
+
+    def __init__(self, env, engine="python", long_range=False, evaluator=None):
+        super().__init__(env)
+        self.set_engine(engine)
+        # approach targets beyond the bfs horizon with the hierarchical planner
+        self.long_range = long_range
+        # ParallelEvaluator scoring actions in worker processes, see `parallel.py`
+        self.evaluator = evaluator
+        # {reward name -> [(action, reward)]} of the last decision, for debugging
+        self.last_rewards = {}
+
+    def set_engine(self, engine):
+        """switch the board engine, takes effect from the next evaluation"""
+        if engine not in self.ENGINES:
+            raise ValueError("Unknown board engine: {}".format(engine))
+        self.engine = engine
+
+    @slog.catch
+    @timed("strategy.best_action")
     def best_action(self):
         """
         chose the action that maximize rewards
@@ -79,47 +89,33 @@ class RewardMaxStrategy(Stratey):
         player_actions_prios = [
             ACTION_TO_PRIORITY[action] for action in player_next_actions
         ]
-        agents_action_to_proba = self.next_actions_of_others()
-        agents_position_to_proba = self.next_positions_of_others()
+        parallel = self.evaluator is not None and self.evaluator.worth_it(self)
 
         # for each action of player, we calculate the expected combat reward
-        expected_move_combat_rewards = []
-        expected_shoot_combat_rewards = []
-        expected_enemy_move_combat_rewards = []
-        expected_enemy_combat_approaching_rewards = []
-
-        for p_action in player_next_actions:
-            expected_move_combat_rewards.append(
-                self.move_combat_reward(p_action, agents_action_to_proba))
-            expected_shoot_combat_rewards.append(
-                self.shoot_combat_reward(p_action, agents_action_to_proba))
-            expected_enemy_move_combat_rewards.append(
-                self.enemy_move_combat_reward(p_action,
-                                              agents_action_to_proba))
-            expected_enemy_combat_approaching_rewards.append(
-                self.enemy_combat_approaching_reward(p_action,
-                                                     agents_position_to_proba))
-
-        # sum of all combat rewards
-        tot_combat_rewards = [
-            expected_move_combat_rewards[i] +
-            expected_shoot_combat_rewards[i] +
-            expected_enemy_move_combat_rewards[i] +
-            expected_enemy_combat_approaching_rewards[i]
-            for i in range(len(player_next_actions))
-        ]
+        if parallel:
+            tot_combat_rewards = self.evaluator.combat_rewards(
+                self, player_next_actions)
+        else:
+            tot_combat_rewards = self.combat_rewards(player_next_actions)
+
+        self.last_rewards = {
+            "combat": list(zip(player_next_actions, tot_combat_rewards))
+        }
 
         # first: chose the action that maximize the expected combat reward
         # combat first!
-        logger.info("Combat Rewards of each action: {}".format(
-            list(zip(player_next_actions, tot_combat_rewards))))
+        if slog.enabled:
+            slog.info("Combat Rewards of each action: {rewards}",
+                      rewards=self.last_rewards["combat"])
         best_action, max_reward = select_max(player_next_actions,
                                              tot_combat_rewards,
                                              player_actions_prios)
         if max_reward != 0:
-            logger.info(
-                "Best action: {} selected using combat reward: {}".format(
-                    max_reward, str(best_action)))
+            if slog.enabled:
+                slog.info(
+                    "Best action: {action} selected using combat reward: {reward}",
+                    action=best_action,
+                    reward=max_reward)
             # exploration action breaks
             if self.env.last_exploration_action is not None:
                 self.env.last_exploration_action = None
@@ -141,35 +137,80 @@ class RewardMaxStrategy(Stratey):
                     # reset inertia
                     self.env.last_exploration_action = None
                     self.env.exploration_inertia = 4
-                logger.info(
-                    "Best action: {} selected using last exploration action".format(best_action))
+                if slog.enabled:
+                    slog.info(
+                        "Best action: {action} selected using last exploration action",
+                        action=best_action)
                 return best_action
 
         #  action_to_combat_reward = dict(
             #  zip(player_next_actions, tot_combat_rewards))
-        expected_exploration_rewards = []
-        moves_actions = []
-        for p_action in player_next_actions:
-            if isinstance(p_action,
-                          MOVEACTION) and p_action != MOVEACTION.INVALID:
-                reward = self.exploration_reward(p_action)
-                # we add move combat to exploration to prevent agent selects a action
-                # that has negative combat rewards, e.g., death of player, in case it happens
-                #  reward += action_to_combat_reward[p_action]
-                expected_exploration_rewards.append(reward)
-                moves_actions.append(p_action)
-
+        moves_actions = [
+            p_action for p_action in player_next_actions
+            if isinstance(p_action, MOVEACTION)
+            and p_action != MOVEACTION.INVALID
+        ]
+        # we add move combat to exploration to prevent agent selects a action
+        # that has negative combat rewards, e.g., death of player, in case it happens
+        #  reward += action_to_combat_reward[p_action]
+        if parallel:
+            expected_exploration_rewards = self.evaluator.exploration_rewards(
+                self, moves_actions)
+        else:
+            expected_exploration_rewards = [
+                self.exploration_reward(p_action) for p_action in moves_actions
+            ]
+
+        self.last_rewards["exploration"] = list(
+            zip(moves_actions, expected_exploration_rewards))
         best_action, max_reward = select_max(moves_actions,
                                              expected_exploration_rewards,
                                              player_actions_prios)
-        logger.info(
-            "Best action: {} selected using exploration reward: {}".format(
-                max_reward, str(best_action)))
+        if slog.enabled:
+            slog.info(
+                "Best action: {action} selected using exploration reward: {reward}",
+                action=best_action,
+                reward=max_reward)
         # remember this exploration action
         self.env.last_exploration_action = best_action
         self.env.exploration_inertia = 4
         return str(best_action)
 
+    def combat_rewards(self, player_actions, indices=None):
+        """
+        Expected combat reward of each next action of player, that is the sum of
+        move combat, shoot combat, enemy move combat and enemy approaching rewards
+
+        Args:
+            player_actions (list): all next actions of player, in order of evaluation
+            indices (list(int)): sorted indices of the actions to evaluate, default to all
+        Returns:
+            rewards (list): combat reward of each evaluated action
+        """
+        agents_action_to_proba = self.next_actions_of_others()
+        agents_position_to_proba = self.next_positions_of_others()
+        if indices is None:
+            indices = range(len(player_actions))
+
+        rewards = []
+        evaluated = 0
+        for i in indices:
+            # enemies killed by the previous actions are no longer approached,
+            # as if they were evaluated too
+            for previous_action in player_actions[evaluated:i]:
+                self.remove_killed_enemies(previous_action,
+                                           agents_position_to_proba)
+            evaluated = i + 1
+            p_action = player_actions[i]
+            rewards.append(
+                self.move_combat_reward(p_action, agents_action_to_proba) +
+                self.shoot_combat_reward(p_action, agents_action_to_proba) +
+                self.enemy_move_combat_reward(p_action, agents_action_to_proba)
+                + self.enemy_combat_approaching_reward(
+                    p_action, agents_position_to_proba))
+        return rewards
+
+    @timed("predict.next_actions")
     def next_actions_of_others(self):
         """
         All possible actions of other agents (player or enemies) in visible area
@@ -184,6 +225,7 @@ class RewardMaxStrategy(Stratey):
             agent_to_actions[enemy] = enemy.next_actions(self.env)
         return agent_to_actions
 
+    @timed("predict.next_positions")
     def next_positions_of_others(self):
         """
         All possible positions of other agents (player or enemies) in visible area
@@ -214,6 +256,42 @@ class RewardMaxStrategy(Stratey):
             positions_to_shot_moves (dict): {target_position -> number of moves to get a shot of enemy}
             positions_to_move (dict): {target_position -> number of moves to touch enemy}
         """
+        if self.engine == "bitboard":
+            moves = self.env.bitboard().moves_to_target(
+                player_position, target_positions, max_step)
+        elif self.engine == "incremental":
+            moves = self.env.incremental().moves_to_target(
+                player_position, target_positions, max_step)
+        else:
+            moves = self._bfs_moves_to_target(player_position,
+                                              target_positions, max_step)
+        if self.long_range:
+            self._long_range_moves_to_target(player_position,
+                                             target_positions, *moves)
+        return moves
+
+    def _long_range_moves_to_target(self, player_position, target_positions,
+                                    positions_to_shot_moves,
+                                    positions_to_move):
+        """
+        Complete `moves_to_target` with the targets the bfs could not reach in max steps,
+        using the distance of the hierarchical planner. The shot is then estimated one
+        move before touching the target, the previous cell of a path having a clear shot.
+        """
+        planner = self.env.planner()
+        for pos in target_positions:
+            if pos in positions_to_move:
+                continue
+            moves = planner.distance(player_position, pos)
+            if moves is None:
+                continue
+            positions_to_move[pos] = moves
+            if pos not in positions_to_shot_moves:
+                positions_to_shot_moves[pos] = max(0, moves - 1)
+
+    def _bfs_moves_to_target(self, player_position, target_positions,
+                             max_step):
+        """`moves_to_target` walking the board cell by cell"""
         positions_to_shot_moves = {}
         positions_to_move = {}
         queue = deque([])
@@ -268,6 +346,7 @@ class RewardMaxStrategy(Stratey):
         #  positions_to_move[pos] = 999999
         return positions_to_shot_moves, positions_to_move
 
+    @timed("reward.move_combat")
     def move_combat_reward(self, player_action, agents_action_to_proba):
         """ After knowning the next actions of all agents and the corresponding
         probabilities, calculate the expected rewards if player takes a next action.
@@ -288,9 +367,11 @@ class RewardMaxStrategy(Stratey):
         """
         player_position = player_action.move(self.env.player.x,
                                              self.env.player.y)
-        logger.info(
-            "==[Move combat reward] player action: {}, player position: {}==".
-            format(str(player_action), player_position))
+        if slog.enabled:
+            slog.info(
+                "==[Move combat reward] player action: {action}, player position: {position}==",
+                action=player_action,
+                position=player_position)
         reward = 0
         killed_by_others, killed_by_enemies, kill_enemies = 0, 0, 0
         for agent, acts_to_prob in agents_action_to_proba.items():
@@ -304,14 +385,19 @@ class RewardMaxStrategy(Stratey):
                 for act, proba in zip(*acts_to_prob):
                     if player_position == act.move(agent.x, agent.y):
                         killed_by_others += proba
-        logger.info(
-            "Killed_by_others: {}, killed_by_enemies: {}, kill_enemies: {}".
-            format(killed_by_others, killed_by_enemies, kill_enemies))
         reward = (killed_by_enemies +
                   killed_by_others) * (-1500) + kill_enemies * 1500
-        logger.info("Final move combat: {}".format(reward))
+        if slog.enabled:
+            slog.info(
+                "Killed_by_others: {killed_by_others}, killed_by_enemies: {killed_by_enemies}, "
+                "kill_enemies: {kill_enemies}, final move combat: {reward}",
+                killed_by_others=killed_by_others,
+                killed_by_enemies=killed_by_enemies,
+                kill_enemies=kill_enemies,
+                reward=reward)
         return reward
 
+    @timed("reward.shoot_combat")
     def shoot_combat_reward(self, player_action, agents_action_to_proba):
         """
         Here, we process all shot and then calculate the expected shoot rewards,
@@ -322,9 +408,11 @@ class RewardMaxStrategy(Stratey):
         """
         player_position = player_action.move(self.env.player.x,
                                              self.env.player.y)
-        logger.info(
-            "==[Shoot combat reward] player action: {}, player position: {}==".
-            format(str(player_action), player_position))
+        if slog.enabled:
+            slog.info(
+                "==[Shoot combat reward] player action: {action}, player position: {position}==",
+                action=player_action,
+                position=player_position)
 
         # note, all the three are expected times
         killed, kill_others, kill_enemies = 0, 0, 0
@@ -352,12 +440,18 @@ class RewardMaxStrategy(Stratey):
                     if self.env.can_shoot(player_position, player_action,
                                           agents_next_position):
                         kill_others += proba
-        logger.info("Killed: {}, kill_others: {}, kill_enemies: {}".format(
-            killed, kill_others, kill_enemies))
         reward = killed * (-1500) + kill_enemies * 500 + kill_others * 750
-        logger.info("Final shoot reward:{}".format(reward))
+        if slog.enabled:
+            slog.info(
+                "Killed: {killed}, kill_others: {kill_others}, kill_enemies: {kill_enemies}, "
+                "final shoot reward: {reward}",
+                killed=killed,
+                kill_others=kill_others,
+                kill_enemies=kill_enemies,
+                reward=reward)
         return reward
 
+    @timed("reward.enemy_move_combat")
     def enemy_move_combat_reward(self, player_action, agents_action_to_proba):
         """
         After processing player moves, player shot, we then process the enemies moves.
@@ -371,9 +465,11 @@ class RewardMaxStrategy(Stratey):
         """
         player_position = player_action.move(self.env.player.x,
                                              self.env.player.y)
-        logger.info(
-            "==[Enemy move combat reward] player action: {}, player position: {}=="
-            .format(str(player_action), player_position))
+        if slog.enabled:
+            slog.info(
+                "==[Enemy move combat reward] player action: {action}, player position: {position}==",
+                action=player_action,
+                position=player_position)
         reward = 0
         kill_enemies, killed = 0, 0
         for agent, acts_to_prob in agents_action_to_proba.items():
@@ -395,12 +491,35 @@ class RewardMaxStrategy(Stratey):
                     else:
                         killed += proba
 
-        logger.info("Killed: {}, kill_enemies: {}".format(
-            killed, kill_enemies))
         reward = killed * (-1500) + kill_enemies * 1500
-        logger.info("Final enemy move combat reward:{}".format(reward))
+        if slog.enabled:
+            slog.info(
+                "Killed: {killed}, kill_enemies: {kill_enemies}, "
+                "final enemy move combat reward: {reward}",
+                killed=killed,
+                kill_enemies=kill_enemies,
+                reward=reward)
         return reward
 
+    def remove_killed_enemies(self, player_action, enemies_positions_to_prob):
+        """
+        Remove from `enemies_positions_to_prob` the enemies killed by the player action
+        """
+        player_position = player_action.move(self.env.player.x,
+                                             self.env.player.y)
+        all_enemies = list(enemies_positions_to_prob.keys())
+        for enemy in all_enemies:
+            if isinstance(player_action, MOVEACTION):
+                if player_position == (enemy.x, enemy.y) and enemy.is_neutral:
+                    del enemies_positions_to_prob[enemy]
+            elif isinstance(player_action, FIREACTION):
+                if self.env.can_shoot(player_position, player_action,
+                                      (enemy.x, enemy.y)):
+                    del enemies_positions_to_prob[enemy]
+            else:
+                pass
+
+    @timed("reward.enemy_approaching")
     def enemy_combat_approaching_reward(self, player_action,
                                         enemies_positions_to_prob):
         """
@@ -417,21 +536,13 @@ class RewardMaxStrategy(Stratey):
         """
         player_position = player_action.move(self.env.player.x,
                                              self.env.player.y)
-        logger.info(
-            "==[Enemy approaching reward] player action: {}, player position: {}=="
-            .format(str(player_action), player_position))
+        if slog.enabled:
+            slog.info(
+                "==[Enemy approaching reward] player action: {action}, player position: {position}==",
+                action=player_action,
+                position=player_position)
         # first, remove enemy that are already dead by player action
-        all_enemies = list(enemies_positions_to_prob.keys())
-        for enemy in all_enemies:
-            if isinstance(player_action, MOVEACTION):
-                if player_position == (enemy.x, enemy.y) and enemy.is_neutral:
-                    del enemies_positions_to_prob[enemy]
-            elif isinstance(player_action, FIREACTION):
-                if self.env.can_shoot(player_position, player_action,
-                                      (enemy.x, enemy.y)):
-                    del enemies_positions_to_prob[enemy]
-            else:
-                pass
+        self.remove_killed_enemies(player_action, enemies_positions_to_prob)
 
         all_target_positions = set()
         for positions, _ in enemies_positions_to_prob.values():
@@ -452,11 +563,13 @@ class RewardMaxStrategy(Stratey):
                     touch_approaching_reward += 1 / (moves_to_touch +
                                                      1.0) * proba * 50
         reward = shot_approaching_reward + touch_approaching_reward
-        logger.info(
-            "Enemy shot approaching reward:{}".format(shot_approaching_reward))
-        logger.info("Enemy touch approaching reward:{}".format(
-            touch_approaching_reward))
-        logger.info("Final enemy approaching reward:{}".format(reward))
+        if slog.enabled:
+            slog.info(
+                "Enemy shot approaching reward: {shot}, touch approaching reward: {touch}, "
+                "final enemy approaching reward: {reward}",
+                shot=shot_approaching_reward,
+                touch=touch_approaching_reward,
+                reward=reward)
         return reward
 
     def visible_area_reward(self, position):
@@ -464,10 +577,13 @@ class RewardMaxStrategy(Stratey):
         """
         added_area = self.env.added_exploration_area(position[0], position[1])
         reward = added_area * 20
-        logger.info("New exploration area: {}, reward: {}".format(
-            added_area, reward))
+        if slog.enabled:
+            slog.info("New exploration area: {area}, reward: {reward}",
+                      area=added_area,
+                      reward=reward)
         return reward
 
+    @timed("reward.exploration")
     def exploration_reward(self, player_action):
         """
         From the base pos, do a breadth-first walk of the current board within max steps
@@ -478,6 +594,25 @@ class RewardMaxStrategy(Stratey):
         It means that the x-axis values of all next possible should be greater
         than the agent.x.
         """
+        if self.engine in ("bitboard", "incremental"):
+            board = self.env.bitboard() if self.engine == "bitboard" \
+                else self.env.incremental()
+            exploration = board.exploration(
+                (self.env.player.x, self.env.player.y), player_action,
+                self.env.exploration_max_step, self.env.board_heatmap)
+        else:
+            exploration = self._exploration_walk(player_action)
+        # calculate exploration reward
+        reward = exploration["heat"]
+        if slog.enabled:
+            slog.info(
+                "Exploration statistics: {statistics}, final exploration reward: {reward}",
+                statistics=exploration,
+                reward=reward)
+        return reward
+
+    def _exploration_walk(self, player_action):
+        """exploration statistics of `exploration_reward`, walking the board cell by cell"""
         position = player_action.move(self.env.player.x,
                                       self.env.player.y)
         seen_positions = set()
@@ -515,8 +650,4 @@ class RewardMaxStrategy(Stratey):
                             (player_action == MOVEACTION.LEFT and nx <= self.env.player.x) or\
                             (player_action == MOVEACTION.RIGHT and nx >= self.env.player.x):
                         positions_to_visit.append(((nx, ny), current_step + 1))
-        logger.info("Exploration statistics: {}".format(exploration))
-        # calculate exploration reward
-        reward = exploration["heat"]
-        logger.info("Final exploration reward: {}".format(reward))
-        return reward
+        return exploration
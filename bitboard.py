@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Board engine working on bitboards: masks of cells stored as python ints.
+
+Cell (x, y) is bit y * stride + x with stride = width + 1. The extra column
+is never set in any mask, so shifting a mask by 1 moves every cell left or
+right without wrapping to the next row, and shifting by stride moves every
+cell up or down. A bfs then expands a whole ring of cells in a few big int
+operations instead of visiting cells one by one.
+"""
+import numpy as np
+
+from common import FIREACTION, MOVEACTION, BoardState
+
+
+FIRE_TO_MOVE = {
+    FIREACTION.UP: MOVEACTION.UP,
+    FIREACTION.DOWN: MOVEACTION.DOWN,
+    FIREACTION.LEFT: MOVEACTION.LEFT,
+    FIREACTION.RIGHT: MOVEACTION.RIGHT
+}
+OPPOSITE_MOVE = {
+    MOVEACTION.UP: MOVEACTION.DOWN,
+    MOVEACTION.DOWN: MOVEACTION.UP,
+    MOVEACTION.LEFT: MOVEACTION.RIGHT,
+    MOVEACTION.RIGHT: MOVEACTION.LEFT
+}
+
+
+def popcount(bits):
+    return bin(bits).count("1")
+
+
+def first_layer(layers, cells):
+    """index of the first layer that contains one of the cells, None if none does"""
+    for step, layer in enumerate(layers):
+        if layer & cells:
+            return step
+    return None
+
+
+def moves_from_layers(board, layers, target_positions, shooting_cells):
+    """
+    `RewardMaxStrategy.moves_to_target` from the bfs rings around the player
+
+    Args:
+        board (BitBoard): board of the layers
+        layers (list(int)): see `BitBoard.bfs_layers`
+        target_positions (list(tuple)): list of target positions
+        shooting_cells (callable): target position -> cells with a clear shot of it
+    Returns:
+        positions_to_shot_moves (dict), positions_to_move (dict)
+    """
+    positions_to_shot_moves = {}
+    positions_to_move = {}
+    for pos in target_positions:
+        shot_step = first_layer(layers, shooting_cells(pos))
+        if shot_step is not None:
+            positions_to_shot_moves[pos] = shot_step
+        move_step = first_layer(layers, board.bit(*pos))
+        if move_step is not None:
+            positions_to_move[pos] = move_step
+    # the reference bfs stops as soon as all targets are touched
+    if target_positions and len(positions_to_move) == len(target_positions):
+        last_step = max(positions_to_move.values())
+        positions_to_shot_moves = {
+            pos: step
+            for pos, step in positions_to_shot_moves.items()
+            if step <= last_step
+        }
+    return positions_to_shot_moves, positions_to_move
+
+
+class BitBoard:
+    def __init__(self, board_array):
+        """
+        Args:
+            board_array (np.array): (height, width) array of BoardState values
+        """
+        self.height, self.width = board_array.shape
+        self.stride = self.width + 1
+        self.size = self.height * self.stride
+        self.walls = self.pack(board_array == BoardState.WALL.value)
+        self.unknown = self.pack(board_array == BoardState.UNKNOWN.value)
+        self.free = self.pack(board_array == BoardState.FREE.value)
+        # cells the player can move to and shoot through
+        self.valid = self.free | self.unknown
+        # first cell of every row
+        self.row_unit = sum(1 << (y * self.stride) for y in range(self.height))
+
+    def pack(self, mask):
+        """(height, width) boolean array -> bitboard"""
+        padded = np.zeros((self.height, self.stride), dtype=bool)
+        padded[:, :self.width] = mask
+        return int.from_bytes(
+            np.packbits(padded.ravel(), bitorder="little").tobytes(),
+            "little")
+
+    def unpack(self, bits):
+        """bitboard -> (height, width) boolean array"""
+        raw = np.frombuffer(bits.to_bytes((self.size + 7) // 8, "little"),
+                            dtype=np.uint8)
+        cells = np.unpackbits(raw, bitorder="little")[:self.size]
+        return cells.reshape(self.height, self.stride)[:, :self.width].astype(bool)
+
+    def bit(self, x, y):
+        return 1 << (y * self.stride + x)
+
+    def rows_between(self, y1, y2):
+        """mask of rows y1..y2 (included)"""
+        if y2 < y1:
+            return 0
+        return ((1 << ((y2 + 1) * self.stride)) - 1) ^ ((1 <<
+                                                         (y1 * self.stride)) - 1)
+
+    def cols_between(self, x1, x2):
+        """mask of columns x1..x2 (included)"""
+        if x2 < x1:
+            return 0
+        # no carry between rows as a row pattern is shorter than the stride
+        return self.row_unit * (((1 << (x2 - x1 + 1)) - 1) << x1)
+
+    def neighbours(self, mask, allowed):
+        """cells of `allowed` that are one move away from a cell of `mask`"""
+        s = self.stride
+        return ((mask << 1) | (mask >> 1) | (mask << s) | (mask >> s)) & allowed
+
+    def shift(self, mask, action):
+        dx, dy = action[0], action[1]
+        offset = dy * self.stride + dx
+        if offset >= 0:
+            return mask << offset
+        return mask >> -offset
+
+    def bfs_layers(self, start, max_step, allowed=None):
+        """
+        Breadth-first rings around start
+
+        Args:
+            start (int): start cells
+            max_step (int): max number of moves
+            allowed (int): cells that can be walked, default to valid cells
+        Returns:
+            layers (list(int)): layers[i] are the cells at i moves from start
+        """
+        if allowed is None:
+            allowed = self.valid
+        layers = [start]
+        seen = start
+        frontier = start
+        for _ in range(max_step):
+            frontier = self.neighbours(frontier, allowed) & ~seen
+            if not frontier:
+                break
+            seen |= frontier
+            layers.append(frontier)
+        return layers
+
+    def reachable(self, start, max_step, allowed=None):
+        """all cells reachable from start within max_step moves"""
+        reached = 0
+        for layer in self.bfs_layers(start, max_step, allowed):
+            reached |= layer
+        return reached
+
+    def ray(self, x, y, action):
+        """
+        Cells seen from (x, y) (excluded) in the direction of `action`
+        until a wall or the border of the board
+        """
+        direction = FIRE_TO_MOVE.get(action, action)
+        cells = 0
+        current = self.bit(x, y)
+        while True:
+            current = self.shift(current, direction) & self.valid
+            if not current:
+                return cells
+            cells |= current
+
+    def shooting_cells(self, x, y):
+        """cells from which (x, y) can be shot, i.e., cells with a clear line to (x, y)"""
+        cells = 0
+        for action in FIREACTION:
+            cells |= self.ray(x, y, action)
+        return cells
+
+    def is_valid(self, x, y):
+        if x < 0 or x > self.width - 1 or y < 0 or y > self.height - 1:
+            return False
+        return bool(self.valid & self.bit(x, y))
+
+    def can_shoot(self, agent_pos, action, target_pos):
+        """same as `RecurrentEnvironment.can_shoot`"""
+        if not isinstance(action, FIREACTION):
+            return False
+        if not action.can_shoot(agent_pos, target_pos):
+            return False
+        # no wall between the two cells: the cell right before the target
+        # is the agent or is seen by the agent
+        before_target = self.shift(self.bit(*target_pos),
+                                   OPPOSITE_MOVE[FIRE_TO_MOVE[action]])
+        return before_target == self.bit(*agent_pos) or bool(
+            before_target & self.ray(agent_pos[0], agent_pos[1], action))
+
+    def count_unknown(self, x1, y1, x2, y2):
+        """number of unknown cells in the rectangle (x1, y1), (x2, y2) (included)"""
+        return popcount(self.unknown & self.rows_between(y1, y2)
+                        & self.cols_between(x1, x2))
+
+    def moves_to_target(self, player_position, target_positions, max_step=12):
+        """
+        Same as `RewardMaxStrategy.moves_to_target` computed on bfs rings
+        """
+        layers = self.bfs_layers(self.bit(*player_position), max_step)
+        return moves_from_layers(self, layers, target_positions,
+                                 lambda pos: self.shooting_cells(*pos))
+
+    def exploration_walk(self, player_position, player_action, max_step):
+        """
+        Cells visited by the walk of `RewardMaxStrategy.exploration_reward`
+
+        Args:
+            player_position (tuple): current position of player
+            player_action (MOVEACTION): next move of player
+            max_step (int): max number of moves of the walk
+        Returns:
+            seen (int): visited cells
+            steps (int): moves walked, less than max_step if the walk ended
+                before, it is then the same walk with any larger max_step
+        """
+        px, py = player_position
+        x, y = player_action.move(px, py)
+        # <don't go back> check
+        if player_action == MOVEACTION.UP:
+            forward = self.rows_between(0, py)
+        elif player_action == MOVEACTION.DOWN:
+            forward = self.rows_between(py, self.height - 1)
+        elif player_action == MOVEACTION.LEFT:
+            forward = self.cols_between(0, px)
+        else:
+            forward = self.cols_between(px, self.width - 1)
+        allowed = self.valid & forward
+
+        start = self.bit(x, y)
+        seen = start
+        frontier = start
+        steps = 0
+        for _ in range(max_step):
+            # the walk doesn't continue from unknown cells
+            frontier = self.neighbours(frontier & ~self.unknown,
+                                       allowed) & ~seen
+            if not frontier:
+                break
+            seen |= frontier
+            steps += 1
+        return seen, steps
+
+    def exploration(self, player_position, player_action, max_step, heatmap):
+        """
+        Same walk as `RewardMaxStrategy.exploration_reward` computed on bfs rings
+
+        Args:
+            player_position (tuple): current position of player
+            player_action (MOVEACTION): next move of player
+            max_step (int): max number of moves of the walk
+            heatmap (np.array): board heatmap
+        Returns:
+            exploration (dict): number of "unknown" and "known" cells visited and their "heat"
+        """
+        seen, _ = self.exploration_walk(player_position, player_action, max_step)
+        known = self.unpack(seen & self.free)
+        unknown = popcount(seen & self.unknown)
+        return {
+            "unknown": unknown,
+            "known": int(known.sum()),
+            "heat": np.minimum(20, heatmap[known]).sum() + 20 * unknown
+        }
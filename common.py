@@ -75,7 +75,7 @@ class Agent:
     x = attr.ib()
     y = attr.ib()
     is_dead = attr.ib(default=False)
-    positions = attr.ib(default=[])
+    positions = attr.ib(default=attr.Factory(list))
 
     def can_move_to(self, nx, ny, env):
         """
@@ -83,6 +83,29 @@ class Agent:
         """
         return env.valid_pos(nx, ny)
 
+    def cache_key(self, env):
+        """
+        Key of the predictions of this agent in `env.turn_cache`: they only
+        depend on the board, the agent type and position, and its state
+        """
+        return (type(self).__name__, env.board_version, self.x, self.y)
+
+    def _cached(self, env, kind, compute):
+        """
+        Predictions are shared by all consumers during a turn, through the
+        cache of the env (if it has one), which is emptied by `env.update`.
+        Cached lists are shared, they must not be modified.
+        """
+        cache = getattr(env, "turn_cache", None)
+        if cache is None:
+            return compute(env)
+        key = (kind, ) + self.cache_key(env)
+        result = cache.get(key)
+        if result is None:
+            result = compute(env)
+            cache[key] = result
+        return result
+
     def next_positions(self, env):
         """all possible positions in next move
         Args:
@@ -92,6 +115,9 @@ class Agent:
             positions: positions in next move
             proba: probabilities of each positions
         """
+        return self._cached(env, "positions", self._next_positions)
+
+    def _next_positions(self, env):
         actions, act_proba = self.next_actions(env)
         position_proba = defaultdict(float)
         for a, prob in zip(actions, act_proba):
@@ -107,6 +133,9 @@ class Agent:
             actions: actions that agent may take in next move
             proba: probabilities of each positions
         """
+        return self._cached(env, "actions", self._next_actions)
+
+    def _next_actions(self, env):
         actions, proba = [], []
         return actions, proba
 
@@ -115,12 +144,15 @@ class Agent:
 class Player(Agent):
     SHOOT_COOLDOWN_DELAY = 5
 
-    positions = attr.ib(default=[])
-    actions = attr.ib(default=[])
+    positions = attr.ib(default=attr.Factory(list))
+    actions = attr.ib(default=attr.Factory(list))
     shoot_cd = attr.ib(default=0)
     can_shoot = attr.ib(default=True)
 
-    def next_actions(self, env):
+    def cache_key(self, env):
+        return super().cache_key(env) + (self.can_shoot, )
+
+    def _next_actions(self, env):
         """
         #TODO: build a behavoir proba distribution
         according to behavoir of agent
@@ -144,7 +176,7 @@ class Player(Agent):
 class Enemy(Agent):
     is_neutral = attr.ib(default=True)
 
-    def next_actions(self, env):
+    def _next_actions(self, env):
         actions = []
         for a in list(MOVEACTION):
             # assume that all enemy must move
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Differential checks of the optimized engines against the reference python
+implementation: board primitives (`valid_pos`, `can_shoot`,
+`added_exploration_area`, bfs rings), `moves_to_target`, the four combat rewards,
+`exploration_reward` and the chosen action are computed by both and compared,
+on random boards and on recorded games (game_frames.json). Distances of the
+hierarchical planner are checked against bfs distances, occupancy fields
+against the chained next positions of agents, layout analyses and the layout
+cache against brute force.
+
+    python diffcheck.py --engine bitboard --boards 200
+    python diffcheck.py --engine bitboard --frames game_frames.json
+    python diffcheck.py --workers 2 --boards 50 --width 80 --height 60
+
+The server can run the same comparison on every move with AI_SHADOW_ENGINE,
+see `divergence.py`.
+"""
+import argparse
+import json
+import random
+import sys
+import tempfile
+from collections import defaultdict, deque
+
+import numpy as np
+
+from ai import RewardMaxStrategy
+from common import FIREACTION, MOVEACTION, BoardState, Enemy, Player
+from divergence import DiffChecker, outcome
+from env import RecurrentEnvironment
+from layout import LANE_ACTIONS, TABLES, LayoutAnalysis, LayoutCache
+from log import slog
+from planner import HierarchicalPlanner
+
+
+def bfs_distances(env, source, max_step=None):
+    """{(x, y) -> number of moves from source} walking `env.valid_pos` cells"""
+    if not env.valid_pos(*source):
+        return {}
+    distances = {source: 0}
+    queue = deque([source])
+    while queue:
+        x, y = queue.popleft()
+        step = distances[(x, y)]
+        if max_step is not None and step == max_step:
+            continue
+        for action in MOVEACTION:
+            if action == MOVEACTION.INVALID:
+                continue
+            cell = action.move(x, y)
+            if cell not in distances and env.valid_pos(*cell):
+                distances[cell] = step + 1
+                queue.append(cell)
+    return distances
+
+
+def count_components(passable):
+    """number of 4-connected components of passable cells"""
+    height, width = passable.shape
+    seen = np.zeros_like(passable)
+    count = 0
+    for y, x in np.argwhere(passable).tolist():
+        if seen[y, x]:
+            continue
+        count += 1
+        seen[y, x] = True
+        queue = deque([(x, y)])
+        while queue:
+            cx, cy = queue.popleft()
+            for nx, ny in ((cx - 1, cy), (cx + 1, cy), (cx, cy - 1), (cx, cy + 1)):
+                if 0 <= nx < width and 0 <= ny < height and passable[ny, nx] \
+                        and not seen[ny, nx]:
+                    seen[ny, nx] = True
+                    queue.append((nx, ny))
+    return count
+
+
+def peel_dead_ends(passable):
+    """
+    Remove all cells with at most one neighbour left at once, round after
+    round: cells are numbered by the round they are removed in
+    """
+    depth = np.zeros(passable.shape, dtype=np.int32)
+    left = passable.copy()
+    peel = 0
+    while True:
+        peel += 1
+        padded = np.pad(left, 1).astype(np.int8)
+        degree = padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:]
+        tips = left & (degree <= 1)
+        if not tips.any():
+            return depth
+        depth[tips] = peel
+        left &= ~tips
+
+class DiffHarness(DiffChecker):
+    """DiffChecker with the checks of the harness"""
+
+    def engine_board(self, env):
+        """BitBoard of the candidate engine, the bitboard for the python engine"""
+        if self.engine == "incremental":
+            return env.incremental().board
+        return env.bitboard()
+
+    def warm_engine(self, env):
+        """compute the rewards of the candidate, so that an engine keeping results has some to patch"""
+        _, candidate = self.strategies(env)
+        actions, _ = env.player.next_actions(env)
+        outcome(candidate.combat_rewards, actions)
+        for action in actions:
+            if isinstance(action, MOVEACTION) and action != MOVEACTION.INVALID:
+                outcome(candidate.exploration_reward, action)
+
+    def check_board(self, env, case, rng, samples=50):
+        """board primitives of env against the board of the candidate engine"""
+        board = self.engine_board(env)
+        width, height = env.board_width, env.board_height
+        for y in range(-1, height + 1):
+            for x in range(-1, width + 1):
+                self.compare("valid_pos", "{} ({}, {})".format(case, x, y),
+                             env.valid_pos(x, y), board.is_valid(x, y))
+        for _ in range(samples):
+            agent = (rng.randrange(width), rng.randrange(height))
+            # targets on the same line or column, where walls matter
+            if rng.random() < 0.5:
+                target = (agent[0], rng.randrange(height))
+            else:
+                target = (rng.randrange(width), agent[1])
+            action = rng.choice(list(FIREACTION) + [MOVEACTION.UP])
+            self.compare("can_shoot",
+                         "{} {} {} {}".format(case, agent, action, target),
+                         env.can_shoot(agent, action, target),
+                         board.can_shoot(agent, action, target))
+        if env.short_range_x is not None:
+            for _ in range(samples):
+                nx, ny = rng.randrange(width), rng.randrange(height)
+                x1, x2 = max(0, nx - env.short_range_x), min(width - 1, nx + env.short_range_x)
+                y1, y2 = max(0, ny - env.short_range_y), min(height - 1, ny + env.short_range_y)
+                self.compare("added_exploration_area",
+                             "{} ({}, {})".format(case, nx, ny),
+                             env.added_exploration_area(nx, ny),
+                             board.count_unknown(x1, y1, x2, y2))
+        walkable = [(x, y) for y in range(height) for x in range(width)
+                    if env.valid_pos(x, y)]
+        for source in rng.sample(walkable, min(len(walkable), samples // 10 + 1)):
+            max_step = rng.randint(0, width + height)
+            layers = board.bfs_layers(board.bit(*source), max_step)
+            self.compare("bfs_layers", "{} {} {} steps".format(case, source, max_step),
+                         bfs_distances(env, source, max_step),
+                         {(int(x), int(y)): step
+                          for step, layer in enumerate(layers)
+                          for y, x in np.argwhere(board.unpack(layer))})
+
+    def check_planner(self, env, case, rng, samples=20):
+        """
+        Distances of the hierarchical planner against bfs distances: a target
+        is reached by both or by none, never in fewer moves by the planner.
+        Walls of a copy of the board are then toggled, to check the clusters
+        rebuilt by the planner and its cached distances.
+        """
+        board = RecurrentEnvironment()
+        board.set_board(env.board_array)
+        width, height = board.board_width, board.board_height
+        # few distances kept, so that some are dropped then searched again
+        planner = HierarchicalPlanner(board.board_array,
+                                      cluster_size=rng.randint(2, 10),
+                                      max_distances=samples // 2)
+        walkable = [(x, y) for y in range(height) for x in range(width)
+                    if board.valid_pos(x, y)]
+        if not walkable:
+            return
+        pairs = [(rng.choice(walkable), rng.choice(walkable))
+                 for _ in range(samples)]
+        for round in ("", " walls toggled"):
+            if round:
+                board_array = board.board_array.copy()
+                for _ in range(rng.randint(1, 10)):
+                    x, y = rng.randrange(width), rng.randrange(height)
+                    board_array[y, x] = BoardState.FREE.value \
+                        if board_array[y, x] == BoardState.WALL.value \
+                        else BoardState.WALL.value
+                walls_changed = (board.board_array == BoardState.WALL.value) != (
+                    board_array == BoardState.WALL.value)
+                planner.mark_changed(
+                    (x, y) for y, x in np.argwhere(walls_changed).tolist())
+                board.set_board(board_array)
+                # the last distances searched are still cached, ask them first
+                pairs.reverse()
+            distances = {}
+            for source, target in pairs:
+                if source not in distances:
+                    distances[source] = bfs_distances(board, source)
+                exact = distances[source].get(target)
+                moves = planner.distance(source, target)
+                self.compare("planner_distance",
+                             "{}{} {} -> {}: bfs {}, planner {}".format(
+                                 case, round, source, target, exact, moves),
+                             True,
+                             moves is None if exact is None else
+                             moves is not None and moves >= exact)
+
+    def check_occupancy(self, env, case, rng):
+        """
+        Occupancy fields against the probabilities of `Agent.next_positions`
+        chained move after move, agent by agent
+        """
+        agents = env.other_players + env.enemies
+        steps = rng.randint(1, 6)
+        field = env.occupancy(steps)
+        for i, agent in enumerate(agents):
+            positions = {(agent.x, agent.y): 1.0}
+            for t in range(1, steps + 1):
+                moved = defaultdict(float)
+                for (x, y), proba in positions.items():
+                    if isinstance(agent, Player):
+                        at = Player(x=x, y=y, can_shoot=agent.can_shoot)
+                    else:
+                        at = Enemy(x=x, y=y, is_neutral=agent.is_neutral)
+                    next_positions, next_proba = at.next_positions(env)
+                    if not next_positions:
+                        # stuck agents stay where they are
+                        moved[(x, y)] += proba
+                    for position, p in zip(next_positions, next_proba):
+                        moved[position] += proba * p
+                positions = moved
+                self.compare("occupancy",
+                             "{} agent {} after {} moves".format(case, i, t),
+                             dict(positions),
+                             dict(zip(*field.positions(i, t))))
+        self.compare("occupancy_total", "{} after {} moves".format(case, steps),
+                     float(len(agents)), float(field.board_field(steps).sum()))
+
+    def check_layout(self, env, case, rng, samples=20):
+        """
+        Layout analysis of the walls of env against brute force: chokepoints
+        by removing cells one by one, dead ends by peeling the board, lanes by
+        walking from cells. Then the layout cache: stored maps must agree
+        with every subset of their cells, be the same once loaded again and
+        replace the partial maps they complete.
+        """
+        walls = env.board_array == BoardState.WALL.value
+        passable = ~walls
+        analysis = LayoutAnalysis.from_walls(walls)
+        height, width = walls.shape
+        self.compare("dead_end", case, peel_dead_ends(passable).tolist(),
+                     analysis.dead_end.tolist())
+        cells = [(x, y) for y, x in np.argwhere(passable).tolist()]
+        components = count_components(passable)
+        for x, y in rng.sample(cells, min(len(cells), samples)):
+            passable[y, x] = False
+            self.compare("chokepoint", "{} ({}, {})".format(case, x, y),
+                         count_components(passable) > components,
+                         bool(analysis.chokepoint[y, x]))
+            passable[y, x] = True
+            lanes = []
+            for action in LANE_ACTIONS:
+                length, (nx, ny) = 0, action.move(x, y)
+                while 0 <= nx < width and 0 <= ny < height and passable[ny, nx]:
+                    length += 1
+                    nx, ny = action.move(nx, ny)
+                lanes.append(length)
+            self.compare("lanes", "{} ({}, {})".format(case, x, y), lanes,
+                         [analysis.lane(x, y, action) for action in LANE_ACTIONS])
+
+        with tempfile.TemporaryDirectory() as root:
+            LayoutCache(root).store(analysis)
+            cache = LayoutCache(root)
+            cache.preload(width, height)
+            known = np.array([[rng.random() < 0.5 for _ in range(width)]
+                              for _ in range(height)])
+            stored = cache.match(walls, known)
+            self.compare("layout_cache", "{} match".format(case), analysis.key,
+                         None if stored is None else stored.key)
+            if stored is not None:
+                self.compare("layout_cache", "{} stored tables".format(case),
+                             [True] * len(TABLES),
+                             [np.array_equal(getattr(analysis, name),
+                                             getattr(stored, name))
+                              for name in TABLES])
+            if cells:
+                # a known wall where the map has none
+                x, y = rng.choice(cells)
+                other = walls.copy()
+                other[y, x] = known[y, x] = True
+                stored = cache.match(other, known)
+                self.compare("layout_cache", "{} wall at ({}, {})".format(case, x, y),
+                             None, None if stored is None else stored.key)
+
+        with tempfile.TemporaryDirectory() as root:
+            cache = LayoutCache(root)
+            known = np.array([[rng.random() < 0.5 for _ in range(width)]
+                              for _ in range(height)])
+            cache.store(LayoutAnalysis.from_walls(walls & known, known))
+            cache.store(analysis)
+            self.compare("layout_cache", "{} superseded".format(case),
+                         [analysis.key],
+                         [path.stem for path in cache.root.glob("*.npz")])
+
+    def check_rewards(self, env, case):
+        """moves_to_target, combat and exploration rewards of every next action of player"""
+        reference, candidate = self.strategies(env)
+        player = env.player
+        agents_action_to_proba = reference.next_actions_of_others()
+        agents_position_to_proba = reference.next_positions_of_others()
+        targets = sorted({pos
+                          for positions, _ in agents_position_to_proba.values()
+                          for pos in positions})
+        self.compare("moves_to_target", case,
+                     outcome(reference.moves_to_target, (player.x, player.y), targets),
+                     outcome(candidate.moves_to_target, (player.x, player.y), targets))
+
+        actions, _ = player.next_actions(env)
+        for action in actions:
+            action_case = "{} {}".format(case, action)
+            for name in ("move_combat_reward", "shoot_combat_reward",
+                         "enemy_move_combat_reward"):
+                self.compare(name, action_case,
+                             outcome(getattr(reference, name), action, agents_action_to_proba),
+                             outcome(getattr(candidate, name), action, agents_action_to_proba))
+            # the approaching reward removes killed enemies from the dict it is given
+            self.compare("enemy_combat_approaching_reward", action_case,
+                         outcome(reference.enemy_combat_approaching_reward,
+                                 action, dict(agents_position_to_proba)),
+                         outcome(candidate.enemy_combat_approaching_reward,
+                                 action, dict(agents_position_to_proba)))
+            if isinstance(action, MOVEACTION) and action != MOVEACTION.INVALID:
+                self.compare("exploration_reward", action_case,
+                             outcome(reference.exploration_reward, action),
+                             outcome(candidate.exploration_reward, action))
+
+        if self.evaluator is not None:
+            self.compare("combat_rewards", case,
+                         outcome(reference.combat_rewards, actions),
+                         outcome(self.evaluator.combat_rewards, candidate, actions))
+        # the reference also fails on some boards (e.g. a player without
+        # any move), it is recorded by the comparison
+        outcome(self.compare_best_actions, reference, candidate, case,
+                reference)
+
+
+def random_env(rng, width, height, wall_ratio=0.2, unknown_ratio=0.3,
+               n_players=3, n_enemies=6):
+    """
+    Environment in the middle of a random game: random board, heatmap,
+    agents and exploration state
+    """
+    env = RecurrentEnvironment()
+    env.init_board(width, height)
+    cells = rng.choices([BoardState.WALL, BoardState.UNKNOWN, BoardState.FREE],
+                        weights=[wall_ratio, unknown_ratio,
+                                 1 - wall_ratio - unknown_ratio],
+                        k=width * height)
+    env.set_board(np.array([c.value for c in cells], dtype=np.int8).reshape(height, width))
+    env.board_heatmap[...] = np.array(
+        [rng.randrange(40) for _ in range(width * height)]).reshape(height, width)
+    walkable = [(x, y) for y in range(height) for x in range(width)
+                if cells[y * width + x] != BoardState.WALL]
+    positions = rng.sample(walkable, min(len(walkable), 1 + n_players + n_enemies))
+    (px, py), others = positions[0], positions[1:]
+    env.player = Player(x=px, y=py, can_shoot=rng.random() < 0.8,
+                        positions=[(px, py)])
+    env.other_players = [Player(x=x, y=y) for x, y in others[:n_players]]
+    env.enemies = [Enemy(x=x, y=y, is_neutral=rng.random() < 0.5)
+                   for x, y in others[n_players:]]
+    env.short_range_x, env.short_range_y = rng.randint(2, 6), rng.randint(2, 6)
+    env.varea_x1, env.varea_x2 = max(0, px - env.short_range_x), min(width - 1, px + env.short_range_x)
+    env.varea_y1, env.varea_y2 = max(0, py - env.short_range_y), min(height - 1, py + env.short_range_y)
+    env.exploration_max_step = rng.randint(2, 12)
+    return env
+
+
+def change_cells(rng, env, n_cells):
+    """
+    Change the state of n_cells random cells of env but the cells of agents,
+    through `set_board` as a new turn would
+    """
+    agents = {(a.x, a.y) for a in [env.player] + env.other_players + env.enemies}
+    board_array = env.board_array.copy()
+    for _ in range(n_cells):
+        x, y = rng.randrange(env.board_width), rng.randrange(env.board_height)
+        if (x, y) not in agents:
+            board_array[y, x] = rng.choice(list(BoardState)).value
+    env.set_board(board_array)
+
+
+def recorded_envs(path):
+    """replay the frames of a recorded game, yields the env at each step"""
+    with open(path) as f:
+        frames = json.load(f)
+    env = RecurrentEnvironment()
+    for frame in frames:
+        env.update(frame)
+        yield env
+        env.update_after_player_action(frame.get("player_action"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--engine", default="bitboard",
+                        choices=RewardMaxStrategy.ENGINES)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="also compare the parallel evaluation, with this number of processes")
+    parser.add_argument("--boards", type=int, default=100,
+                        help="number of random boards")
+    parser.add_argument("--width", type=int, default=30)
+    parser.add_argument("--height", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--frames", action="append", default=[],
+                        help="game_frames.json of a recorded game, can be repeated")
+    args = parser.parse_args(argv)
+
+    slog.configure(level="OFF")
+    evaluator = None
+    if args.workers > 0:
+        from parallel import ParallelEvaluator
+        evaluator = ParallelEvaluator(args.workers)
+    checker = DiffHarness(args.engine, evaluator)
+    rng = random.Random(args.seed)
+    for i in range(args.boards):
+        width = rng.randint(3, args.width)
+        height = rng.randint(3, args.height)
+        env = random_env(rng, width, height,
+                         wall_ratio=rng.uniform(0, 0.4),
+                         unknown_ratio=rng.uniform(0, 0.5))
+        case = "board {} ({}x{})".format(i, width, height)
+        # engines keeping results between turns patch them with the changed cells
+        checker.warm_engine(env)
+        change_cells(rng, env, rng.randint(1, 20))
+        # walks that ended before max_step are kept for another max_step
+        env.exploration_max_step = rng.randint(2, 12)
+        checker.check_board(env, case, rng)
+        checker.check_rewards(env, case)
+        checker.check_planner(env, case, rng)
+        checker.check_occupancy(env, case, rng)
+        checker.check_layout(env, case, rng)
+        # the next env can then get the same id, as in a process serving
+        # games one after the other: the evaluator must not take it for this one
+        del env
+    for path in args.frames:
+        for env in recorded_envs(path):
+            case = "{} step {}".format(path, env.step - 1)
+            checker.check_board(env, case, rng)
+            checker.check_rewards(env, case)
+            checker.check_planner(env, case, rng)
+            checker.check_occupancy(env, case, rng)
+            checker.check_layout(env, case, rng)
+    if evaluator is not None:
+        evaluator.close()
+    print(checker.report())
+    return 1 if checker.divergences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Comparison of a candidate strategy with the reference one: values computed by
+both are compared and their differences recorded as divergences.
+
+The server compares the moves of a shadow engine on every move with it
+(AI_SHADOW_ENGINE), `diffcheck.py` compares everything on random boards and
+recorded games.
+"""
+import math
+from collections import Counter, deque
+
+import attr
+import numpy as np
+
+from ai import RewardMaxStrategy
+from log import slog
+from metrics import ENGINE_CHECKS, ENGINE_DIVERGENCES
+
+
+@attr.s
+class Divergence:
+    check = attr.ib()
+    case = attr.ib()
+    reference = attr.ib()
+    candidate = attr.ib()
+
+    def __str__(self):
+        return "{}: {}\n  reference: {}\n  candidate: {}".format(
+            self.case, self.check, self.reference, self.candidate)
+
+
+def outcome(compute, *args):
+    """result of compute(*args), or the name of the exception it raised"""
+    try:
+        return compute(*args)
+    except Exception as e:
+        return "raised {}".format(type(e).__name__)
+
+
+def same(reference, candidate, rel_tol):
+    """equality, up to rel_tol for floats, within containers"""
+    if isinstance(reference, dict) and isinstance(candidate, dict):
+        return reference.keys() == candidate.keys() and all(
+            same(v, candidate[k], rel_tol) for k, v in reference.items())
+    if isinstance(reference, (list, tuple)) and isinstance(candidate, (list, tuple)):
+        return len(reference) == len(candidate) and all(
+            same(r, c, rel_tol) for r, c in zip(reference, candidate))
+    if isinstance(reference, (float, np.floating)) or isinstance(
+            candidate, (float, np.floating)):
+        try:
+            return math.isclose(reference, candidate, rel_tol=rel_tol,
+                                abs_tol=rel_tol)
+        except TypeError:
+            return False
+    return reference == candidate
+
+def exploration_state(env):
+    return (env.last_exploration_action, env.exploration_inertia)
+
+
+def restore_exploration_state(env, state):
+    env.last_exploration_action, env.exploration_inertia = state
+
+class DiffChecker:
+    def __init__(self, engine="bitboard", evaluator=None, rel_tol=1e-9,
+                 max_divergences=None):
+        """
+        Args:
+            engine (str): board engine of the candidate strategy
+            evaluator (ParallelEvaluator): evaluator of the candidate strategy
+            rel_tol (float): tolerance on floats, reductions are not done in
+                the same order by all engines
+            max_divergences (int): only keep the last divergences, default to all
+        """
+        self.engine = engine
+        self.evaluator = evaluator
+        self.rel_tol = rel_tol
+        # check -> number of compared values
+        self.checks = Counter()
+        # check -> number of divergences
+        self.diverged = Counter()
+        self.divergences = deque(maxlen=max_divergences)
+
+    def compare(self, check, case, reference, candidate):
+        """record a divergence if reference and candidate differ"""
+        self.checks[check] += 1
+        ENGINE_CHECKS.inc(check)
+        if same(reference, candidate, self.rel_tol):
+            return True
+        self.diverged[check] += 1
+        ENGINE_DIVERGENCES.inc(check)
+        divergence = Divergence(check, case, reference, candidate)
+        self.divergences.append(divergence)
+        if slog.enabled:
+            slog.log("WARNING", "Engine divergence {divergence}",
+                     divergence=divergence)
+        return False
+
+    def strategies(self, env):
+        """(reference, candidate) strategies playing on env"""
+        return (RewardMaxStrategy(env),
+                RewardMaxStrategy(env, engine=self.engine,
+                                  evaluator=self.evaluator))
+    def compare_best_actions(self, reference, candidate, case, play):
+        """
+        Best action and rewards of both strategies on the current turn, the
+        exploration state of the env is only updated by the strategy that plays
+
+        Args:
+            reference (RewardMaxStrategy): reference strategy
+            candidate (RewardMaxStrategy): strategy compared with reference
+            case (str): description of the turn
+            play (RewardMaxStrategy): reference or candidate, the one whose action is returned
+        Returns:
+            action (str): action of `play`, its exception is raised again if it failed
+        """
+        env = play.env
+        shadow = candidate if play is reference else reference
+        state = exploration_state(env)
+        shadow_action = outcome(shadow.best_action)
+        restore_exploration_state(env, state)
+        try:
+            action = play.best_action()
+        except Exception as e:
+            self._compare_turn(reference, candidate, case, {
+                play: "raised {}".format(type(e).__name__),
+                shadow: shadow_action
+            })
+            raise
+        self._compare_turn(reference, candidate, case, {
+            play: action,
+            shadow: shadow_action
+        })
+        return action
+
+    def _compare_turn(self, reference, candidate, case, actions):
+        same_action = self.compare("best_action", case, actions[reference],
+                                   actions[candidate])
+        # rewards are left from a previous turn by a strategy that failed
+        if same_action and not actions[reference].startswith("raised"):
+            self.compare("last_rewards", case,
+                         _rewards(reference.last_rewards),
+                         _rewards(candidate.last_rewards))
+
+    def report(self):
+        lines = []
+        for check, count in sorted(self.checks.items()):
+            lines.append("{:<32}{:>8} checked{:>8} diverged".format(
+                check, count, self.diverged[check]))
+        divergences = list(self.divergences)
+        for divergence in divergences[:20]:
+            lines.append(str(divergence))
+        if len(divergences) > 20:
+            lines.append("... {} more divergences".format(
+                len(divergences) - 20))
+        return "\n".join(lines)
+
+def _rewards(last_rewards):
+    return {
+        name: [(str(action), reward) for action, reward in action_rewards]
+        for name, action_rewards in last_rewards.items()
+    }
@@ -1,13 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import hashlib
 import json
+import re
+import shutil
 from pathlib import Path
 
 import attr
 import numpy as np
 
-from common import FIREACTION, BoardState, Enemy, Player
-from loguru import logger
+from common import FIREACTION, MOVEACTION, BoardState, Enemy, Player
+from log import slog
+from bitboard import BitBoard
+from metrics import timed
+from incremental import IncrementalBoard
+from layout import LayoutCache
+from occupancy import OccupancyField
+from planner import HierarchicalPlanner
+from render import render_board
+from util import replace_file
 
 
 class Environment():
@@ -23,7 +34,7 @@ class RecordEnvironement(Environment):
     """
     A environement that just records every response returned by server
     """
-    game_frame = attr.ib(default=[], init=False)
+    game_frame = attr.ib(default=attr.Factory(list), init=False)
     step = attr.ib(default=0, init=False)
 
     def update(self, state):
@@ -39,18 +50,78 @@ class RecordEnvironement(Environment):
         json.dump(self.game_frame, frame_save_path.open('w'))
 
 
+# game ids used as they are for snapshot directories, the others are hashed
+SAFE_GAME_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def snapshot_path(root, game_id):
+    """
+    Directory of the snapshot of a game: game ids come from requests, so
+    anything but a plain name is hashed and never leaves root
+    """
+    name = str(game_id)
+    if not SAFE_GAME_ID.match(name):
+        name = hashlib.sha1(name.encode("utf-8")).hexdigest()
+    return Path(root) / name
+
+
+def prune_snapshots(root, max_snapshots):
+    """
+    Delete the oldest snapshots of root beyond max_snapshots
+
+    Returns:
+        deleted (int): number of deleted snapshots
+    """
+    root = Path(root)
+    if not root.is_dir():
+        return 0
+    snapshots = sorted((path for path in root.iterdir()
+                        if (path / "state.json").is_file()),
+                       key=lambda path: (path / "state.json").stat().st_mtime)
+    deleted = 0
+    for path in snapshots[:max(0, len(snapshots) - max_snapshots)]:
+        try:
+            shutil.rmtree(str(path))
+            deleted += 1
+        except OSError as e:
+            slog.log("WARNING", "Could not delete snapshot {path}: {error}",
+                     path=path, error=e)
+    return deleted
+
+
+# BoardState indexed by value, to convert board arrays back to boards
+BOARD_STATES = np.array(sorted(BoardState, key=lambda s: s.value), dtype=object)
+
+
 @attr.s
 class RecurrentEnvironment(RecordEnvironement):
+    game_id = attr.ib(default=None, init=False)
     exploration_max_step = attr.ib(default=4, init=False)
     last_exploration_action = attr.ib(default=None, init=False)
     exploration_inertia = attr.ib(default=4, init=False)
 
     # board, NOTE: board[ny][nx], ny before nx in indexing
     board = attr.ib(default=None, init=False)
+    # same board as a (height, width) array of BoardState values
+    board_array = attr.ib(default=None, init=False)
     board_heatmap = attr.ib(default=None, init=False)
     board_width = attr.ib(default=None, init=False)
     board_height = attr.ib(default=None, init=False)
-    board_list = attr.ib(default=[], init=False)
+    board_list = attr.ib(default=attr.Factory(list), init=False)
+    # incremented every time the board is updated
+    board_version = attr.ib(default=0, init=False)
+    # (x, y) of the cells changed by the last update of the board, None if unknown
+    changed_cells = attr.ib(default=None, init=False)
+    _bitboard = attr.ib(default=None, init=False)
+    _incremental = attr.ib(default=None, init=False)
+    _planner = attr.ib(default=None, init=False)
+    # predictions of agents for the current turn, see `Agent.next_actions`
+    turn_cache = attr.ib(default=attr.Factory(dict), init=False)
+    # keep a rendering of every step in `board_list`
+    record_boards = attr.ib(default=False)
+    # LayoutCache of analysed wall sets, see `layout`
+    layout_cache = attr.ib(default=attr.Factory(LayoutCache))
+    _layout = attr.ib(default=None, init=False)
 
     # visible area
     varea_x1 = attr.ib(default=-1, init=False)
@@ -61,31 +132,8 @@ class RecurrentEnvironment(RecordEnvironement):
     player = attr.ib(default=None, init=False)
     short_range_x = attr.ib(default=None, init=False)
     short_range_y = attr.ib(default=None, init=False)
-    other_players = attr.ib(default=[], init=False)
-    enemies = attr.ib(default=[], init=False)
-
-    def print_game_board(self):
-        def _print_cell(c):
-            if c == BoardState.FREE:
-                return "_"
-            elif c == BoardState.WALL:
-                return "#"
-            else:
-                return "X"
-
-        rows = [list(map(lambda c: _print_cell(c), r)) for r in self.board]
-        for p in self.other_players:
-            rows[p.y][p.x] = "P"
-        for e in self.enemies:
-            if e.is_neutral:
-                rows[e.y][e.x] = "O"
-            else:
-                rows[e.y][e.x] = "E"
-        rows[self.player.y][self.player.x] = "M"
-        rows = ["  ".join(r) for r in rows]
-        bb = "\n".join(rows)
-        print(bb)
-        self.board_list.append(bb + "\n")
+    other_players = attr.ib(default=attr.Factory(list), init=False)
+    enemies = attr.ib(default=attr.Factory(list), init=False)
 
     def valid_pos(self, x, y):
         if x < 0 or x > self.board_width - 1 \
@@ -112,17 +160,53 @@ class RecurrentEnvironment(RecordEnvironement):
                     count += 1
         return count
 
+    @timed("env.update")
     def update(self, state):
-        logger.info(
-            "====================================Step: {}==============================================="
-            .format(self.step))
+        if slog.enabled:
+            slog.info(
+                "====================================Step: {step}===============================================",
+                step=self.step)
+        self.game_id = state.get("game", {}).get("id", self.game_id)
+        self.turn_cache.clear()
         super().update(state)
         self.update_board(state)
         self.update_other_players(state)
         self.update_enemies(state)
         self.update_player(state)
-        self.print_game_board()
+        # rendering the board is only worth it if someone reads it
+        if self.record_boards or slog.enabled_for("DEBUG"):
+            self.record_board()
+
+    @timed("env.render_board")
+    def record_board(self):
+        bb = render_board(self)
+        slog.debug("Board:\n{board}", board=bb)
+        if self.record_boards:
+            self.board_list.append(bb + "\n")
+
+    def init_board(self, width, height):
+        """init board with all UNKNOWN, if not done yet"""
+        self.board_width = width
+        self.board_height = height
+        if self.board is None:
+            self.board = [[BoardState.UNKNOWN for i in range(width)]
+                          for j in range(height)]
+        if self.board_array is None:
+            self.board_array = np.full((height, width),
+                                       BoardState.UNKNOWN.value,
+                                       dtype=np.int8)
+        if self.board_heatmap is None:
+            self.board_heatmap = np.zeros((height, width))
 
+    def warm_up(self, width, height):
+        """
+        Prepare a game on a width x height board before its first move:
+        allocate the boards and precompute the tables that don't depend on the game
+        """
+        self.init_board(width, height)
+        self.layout_cache.preload(width, height)
+
+    @timed("env.update_board")
     def update_board(self, state):
         """For a board,
         0: unknown space
@@ -132,15 +216,7 @@ class RecurrentEnvironment(RecordEnvironement):
         area = state["player"]["area"]
         size = state["board"]["size"]
         wall = state["board"]["walls"]
-        self.board_width = size["width"]
-        self.board_height = size["height"]
-
-        # init board with all UNKNOWN
-        if self.board is None:
-            self.board = [[BoardState.UNKNOWN for i in range(size["width"])]
-                          for j in range(size["height"])]
-        if self.board_heatmap is None:
-            self.board_heatmap = np.zeros((size["height"], size["width"]))
+        self.init_board(size["width"], size["height"])
 
         # update visible area
         self.varea_x1 = area["x1"]
@@ -148,19 +224,137 @@ class RecurrentEnvironment(RecordEnvironement):
         self.varea_x2 = area["x2"]
         self.varea_y2 = area["y2"]
 
+        # only the visible area and the walls can change
+        x1, y1, x2, y2 = area["x1"], area["y1"], area["x2"], area["y2"]
+        previous_area = self.board_array[y1:y2 + 1, x1:x2 + 1].copy()
+        previous_outside = {(w["x"], w["y"]): self.board_array[w["y"], w["x"]]
+                            for w in wall
+                            if not (x1 <= w["x"] <= x2 and y1 <= w["y"] <= y2)}
+
         # init all visible area as free space
         for x in range(area["x1"], area["x2"] + 1):
             for y in range(area["y1"], area["y2"] + 1):
                 self.board[y][x] = BoardState.FREE
+        self.board_array[area["y1"]:area["y2"] + 1,
+                         area["x1"]:area["x2"] + 1] = BoardState.FREE.value
 
         # update board if there are walls in visible area
         for w in wall:
             self.board[w["y"]][w["x"]] = BoardState.WALL
+            self.board_array[w["y"], w["x"]] = BoardState.WALL.value
+        self.board_version += 1
+
+        # (x, y) -> previous state of the changed cells
+        previous = {(x1 + x, y1 + y): previous_area[y, x]
+                    for y, x in np.argwhere(previous_area != self.board_array[
+                        y1:y2 + 1, x1:x2 + 1]).tolist()}
+        previous.update((cell, value) for cell, value in previous_outside.items()
+                        if value != BoardState.WALL.value)
+        self.changed_cells = list(previous)
+        if self._planner is not None:
+            # the planner only needs to know which walls changed
+            wall_value = BoardState.WALL.value
+            self._planner.mark_changed(
+                (x, y) for (x, y), value in previous.items()
+                if (value == wall_value) != (self.board_array[y, x] == wall_value))
+
+    def set_board(self, board_array):
+        """
+        Replace the board by board_array (same shape), only the changed cells
+        of the board lists are rewritten
 
+        Args:
+            board_array (np.array): (height, width) array of BoardState values
+        """
+        height, width = board_array.shape
+        self.init_board(width, height)
+        changed = self.board_array != board_array
+        if not changed.any():
+            return
+        self.changed_cells = [(x, y) for y, x in np.argwhere(changed).tolist()]
+        if self._planner is not None:
+            walls_changed = (self.board_array == BoardState.WALL.value) != (
+                board_array == BoardState.WALL.value)
+            self._planner.mark_changed(
+                (x, y) for y, x in np.argwhere(walls_changed).tolist())
+        for y, x in np.argwhere(changed).tolist():
+            self.board[y][x] = BOARD_STATES[board_array[y, x]]
+        self.board_array[...] = board_array
+        self.board_version += 1
+
+    def planner(self):
+        """HierarchicalPlanner of the board, kept up to date by `update_board`"""
+        if self._planner is None:
+            self._planner = HierarchicalPlanner(self.board_array)
+        return self._planner
+
+    @timed("env.bitboard")
+    def bitboard(self):
+        """BitBoard of the current board, built once per board version"""
+        if self._bitboard is None or self._bitboard[0] != self.board_version:
+            self._bitboard = (self.board_version, BitBoard(self.board_array))
+        return self._bitboard[1]
+
+    def incremental(self):
+        """IncrementalBoard of the board, synced with the changes since its last use"""
+        if self._incremental is None:
+            self._incremental = IncrementalBoard()
+        self._incremental.sync(self)
+        return self._incremental
+
+    def layout(self):
+        """
+        LayoutAnalysis of the known walls, with the walls of the stored map
+        that agrees with the known cells if any, analysed once per wall set.
+        The map is stored for later games by `store_layout`.
+        """
+        if self._layout is None or self._layout[0] != self.board_version:
+            walls = self.board_array == BoardState.WALL.value
+            known = self.board_array != BoardState.UNKNOWN.value
+            analysis = None if self._layout is None else self._layout[1]
+            if analysis is None or not np.array_equal(analysis.walls[known],
+                                                      walls[known]):
+                stored = self.layout_cache.match(walls, known)
+                if stored is not None:
+                    walls = np.where(known, walls, stored.walls)
+                    known = known | stored.known
+                analysis = self.layout_cache.get(walls, known)
+            self._layout = (self.board_version, analysis)
+        return self._layout[1]
+
+    @timed("env.store_layout")
+    def store_layout(self):
+        """
+        Store what is known of the map, with what the stored map it agrees
+        with knew, for later games on the same map. Done at the end of a game.
+        """
+        if self.board_array is None:
+            return
+        analysis = self.layout()
+        known = analysis.known | (self.board_array != BoardState.UNKNOWN.value)
+        if not np.array_equal(known, analysis.known):
+            analysis = self.layout_cache.get(analysis.walls, known)
+        self.layout_cache.store(analysis)
+
+    def occupancy(self, steps):
+        """
+        OccupancyField of other players then enemies over the next `steps`
+        moves, built once per turn
+        """
+        key = ("occupancy", self.board_version, steps)
+        field = self.turn_cache.get(key)
+        if field is None:
+            field = OccupancyField(self.board_array,
+                                   self.other_players + self.enemies, steps)
+            self.turn_cache[key] = field
+        return field
+
+    @timed("env.update_other_players")
     def update_other_players(self, state):
         players = state["players"]
         self.other_players = [Player(x=p['x'], y=p['y']) for p in players]
 
+    @timed("env.update_enemies")
     def update_enemies(self, state):
         enemies = state["enemies"]
         self.enemies = [
@@ -207,6 +401,7 @@ class RecurrentEnvironment(RecordEnvironement):
                     return False
         return True
 
+    @timed("env.update_player")
     def update_player(self, state):
         if self.player is None:
             self.player = Player(x=0, y=0)
@@ -232,12 +427,111 @@ class RecurrentEnvironment(RecordEnvironement):
     def update_after_player_action(self, action):
         super().update_after_player_action(action)
         self.player.actions.append(action)
-        msg = "Player action: {}".format(str(action))
-        print(msg)
-        self.board_list.append(msg+"\n")
+        if slog.enabled:
+            slog.debug("Player action: {action}", action=action)
+        if self.record_boards:
+            self.board_list.append("Player action: {}\n".format(str(action)))
         self.exploration_max_step = (self.step // 15)*2 + self.exploration_max_step
 
     def save(self, prefix):
         super().save(prefix)
         board_list_file = (Path(prefix) / "board_list.txt").open('w')
         board_list_file.writelines(self.board_list)
+
+    @timed("env.save_snapshot")
+    def save_snapshot(self, root):
+        """
+        Save what the environment learnt about the current game in
+        `snapshot_path(root, game_id)`:
+            - board.npy, heatmap.npy: board arrays
+            - state.json: visible area, exploration state and player history
+        state.json is written last, a snapshot is complete once it exists.
+
+        Args:
+            root (str): snapshots directory
+        Returns:
+            path: directory of the snapshot, None if there is nothing to save yet
+        """
+        if self.game_id is None or self.board_array is None or self.player is None:
+            return None
+        path = snapshot_path(root, self.game_id)
+        path.mkdir(parents=True, exist_ok=True)
+        replace_file(path / "board.npy", lambda f: np.save(f, self.board_array))
+        replace_file(path / "heatmap.npy",
+                      lambda f: np.save(f, self.board_heatmap))
+        last_exploration_action = self.last_exploration_action
+        state = {
+            "game_id": self.game_id,
+            "step": self.step,
+            "board_width": self.board_width,
+            "board_height": self.board_height,
+            "varea": [self.varea_x1, self.varea_y1, self.varea_x2, self.varea_y2],
+            "short_range_x": self.short_range_x,
+            "short_range_y": self.short_range_y,
+            "exploration_max_step": self.exploration_max_step,
+            "last_exploration_action": None if last_exploration_action is None
+            else last_exploration_action.name,
+            "exploration_inertia": self.exploration_inertia,
+            "player": {
+                "x": self.player.x,
+                "y": self.player.y,
+                "can_shoot": self.player.can_shoot,
+                "positions": self.player.positions,
+                "actions": [str(a) for a in self.player.actions]
+            }
+        }
+        replace_file(path / "state.json",
+                      lambda f: f.write(json.dumps(state).encode("utf-8")))
+        return path
+
+    @timed("env.load_snapshot")
+    def load_snapshot(self, root, game_id, size=None):
+        """
+        Restore the snapshot of game `game_id` saved by `save_snapshot`
+
+        Args:
+            root (str): snapshots directory
+            game_id (str): id of the game
+            size (tuple): (width, height) of the board of the game, snapshots of
+                another size are not restored
+        Returns:
+            restored (bool): False if there is no complete snapshot of this game
+        """
+        path = snapshot_path(root, game_id)
+        if not (path / "state.json").exists():
+            return False
+        state = json.loads((path / "state.json").read_text())
+        board_array = np.load(str(path / "board.npy"))
+        if size is not None and board_array.shape != (size[1], size[0]):
+            slog.log("WARNING",
+                     "Ignored snapshot of game {game_id}: board {shape} instead of {size}",
+                     game_id=game_id,
+                     shape=board_array.shape[::-1],
+                     size=tuple(size))
+            return False
+
+        self.game_id = state["game_id"]
+        self.step = state["step"]
+        if self.board_array is not None and self.board_array.shape != board_array.shape:
+            # boards of another size are allocated again by `set_board`
+            self.board = self.board_array = self.board_heatmap = None
+            self._planner = None
+        # only the cells that differ from the current board are rewritten
+        self.set_board(board_array)
+        self.board_heatmap = np.load(str(path / "heatmap.npy"))
+        self.varea_x1, self.varea_y1, self.varea_x2, self.varea_y2 = state[
+            "varea"]
+        self.short_range_x = state["short_range_x"]
+        self.short_range_y = state["short_range_y"]
+        self.exploration_max_step = state["exploration_max_step"]
+        last_exploration_action = state["last_exploration_action"]
+        self.last_exploration_action = None if last_exploration_action is None \
+            else MOVEACTION[last_exploration_action]
+        self.exploration_inertia = state["exploration_inertia"]
+        player = state["player"]
+        self.player = Player(x=player["x"],
+                             y=player["y"],
+                             positions=[tuple(p) for p in player["positions"]],
+                             actions=player["actions"],
+                             can_shoot=player["can_shoot"])
+        return True
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Incremental board engine: the results of the bitboard engine are kept from
+turn to turn and only the ones that depend on changed cells are computed
+again.
+
+Between two moves, `RecurrentEnvironment.update_board` only changes the cells
+of the visible area (`env.changed_cells`). The engine patches its bitboard with
+these cells, then drops the cached results whose region contains one of them:
+
+    - distance fields: bfs rings from a source, up to max_step moves. They
+      only depend on walls within max_step cells of the source
+    - shooting cells (danger map) of a target: cells with a clear shot of it,
+      they only depend on walls on the row and the column of the target
+    - exploration walks: cells visited from a next position of player, they
+      depend on every cell within max_step cells of the start. A walk that
+      ended before max_step moves is the same with a larger max_step
+
+When too many cells changed (or they are unknown, e.g. after a restored
+snapshot), everything is computed again from the board.
+
+Cached results are not repaired: a dropped result is computed again from
+scratch the next time it is asked. Distance fields are keyed by their source,
+the position of the player: they are reused while the player stays in place
+(it shoots or cannot move) or comes back to a cell, but the field of a player
+that moved is always computed again. Shooting cells of targets that did not
+move are reused until a cell of their region changes, and so are exploration
+walks, even though `exploration_max_step` grows with every move of a game:
+walls and unknown cells stop them long before.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from bitboard import BitBoard, moves_from_layers, popcount
+from common import BoardState
+from metrics import INCREMENTAL_RESETS, INCREMENTAL_RESULTS, timed
+
+
+class RegionCache:
+    """results that depend on rectangular regions of the board"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        # key -> (regions, value), regions being [(x1, y1, x2, y2)] (included)
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        return None if entry is None else entry[1]
+
+    def put(self, key, regions, value):
+        self._entries[key] = (regions, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def invalidate(self, cells, bounds):
+        """
+        Drop the results whose regions contain one of the cells
+
+        Args:
+            cells (list(tuple)): (x, y) of changed cells
+            bounds (tuple): (x1, y1, x2, y2) bounding box of cells
+        """
+        bx1, by1, bx2, by2 = bounds
+        dropped = []
+        for key, (regions, _) in self._entries.items():
+            for x1, y1, x2, y2 in regions:
+                if x1 > bx2 or x2 < bx1 or y1 > by2 or y2 < by1:
+                    continue
+                if any(x1 <= x <= x2 and y1 <= y <= y2 for x, y in cells):
+                    dropped.append(key)
+                    break
+        for key in dropped:
+            del self._entries[key]
+
+
+def _bounds(cells):
+    xs = [x for x, _ in cells]
+    ys = [y for _, y in cells]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+class IncrementalBoard:
+    def __init__(self, max_changes=None, max_entries=4096):
+        """
+        Args:
+            max_changes (int): above this number of changed cells, everything is
+                computed again, default to a tenth of the board
+            max_entries (int): results kept per kind, the oldest are dropped
+        """
+        self.max_changes = max_changes
+        self.board = None
+        self.version = None
+        self.fields = RegionCache(max_entries)
+        self.shots = RegionCache(max_entries)
+        self.walks = RegionCache(max_entries)
+
+    def __len__(self):
+        """number of results kept"""
+        return len(self.fields) + len(self.shots) + len(self.walks)
+
+    def _reset(self, board_array):
+        INCREMENTAL_RESETS.inc()
+        self.board = BitBoard(board_array)
+        self.fields.clear()
+        self.shots.clear()
+        self.walks.clear()
+
+    @timed("incremental.sync")
+    def sync(self, env):
+        """take the changes of the board since the last sync into account"""
+        if self.version == env.board_version:
+            return
+        board = self.board
+        max_changes = self.max_changes
+        if max_changes is None:
+            max_changes = max(64, env.board_array.size // 10)
+        cells = env.changed_cells
+        if board is None or self.version + 1 != env.board_version or cells is None \
+                or len(cells) > max_changes \
+                or (board.width, board.height) != (env.board_width, env.board_height):
+            self._reset(env.board_array)
+        elif cells:
+            self._apply(env.board_array, cells)
+        self.version = env.board_version
+
+    def _apply(self, board_array, cells):
+        board = self.board
+        changed = walls = unknown = free = 0
+        wall_cells = []
+        for x, y in cells:
+            bit = board.bit(x, y)
+            changed |= bit
+            value = board_array[y, x]
+            if value == BoardState.WALL.value:
+                walls |= bit
+            elif value == BoardState.UNKNOWN.value:
+                unknown |= bit
+            else:
+                free |= bit
+            if bool(board.walls & bit) != (value == BoardState.WALL.value):
+                wall_cells.append((x, y))
+        board.walls = (board.walls & ~changed) | walls
+        board.unknown = (board.unknown & ~changed) | unknown
+        board.free = (board.free & ~changed) | free
+        board.valid = board.free | board.unknown
+
+        # distances and shots only depend on walls, walks on every cell
+        if wall_cells:
+            bounds = _bounds(wall_cells)
+            self.fields.invalidate(wall_cells, bounds)
+            self.shots.invalidate(wall_cells, bounds)
+        self.walks.invalidate(cells, _bounds(cells))
+
+    def _layers(self, source, max_step):
+        key = (source, max_step)
+        layers = self.fields.get(key)
+        if layers is None:
+            INCREMENTAL_RESULTS.inc("field", "computed")
+            layers = self.board.bfs_layers(self.board.bit(*source), max_step)
+            x, y = source
+            self.fields.put(key, [(x - max_step, y - max_step, x + max_step,
+                                   y + max_step)], layers)
+        else:
+            INCREMENTAL_RESULTS.inc("field", "cache")
+        return layers
+
+    def shooting_cells(self, target):
+        cells = self.shots.get(target)
+        if cells is None:
+            INCREMENTAL_RESULTS.inc("shot", "computed")
+            cells = self.board.shooting_cells(*target)
+            x, y = target
+            self.shots.put(target, [(0, y, self.board.width - 1, y),
+                                    (x, 0, x, self.board.height - 1)], cells)
+        else:
+            INCREMENTAL_RESULTS.inc("shot", "cache")
+        return cells
+
+    def moves_to_target(self, player_position, target_positions, max_step=12):
+        """same as `BitBoard.moves_to_target`"""
+        return moves_from_layers(self.board,
+                                 self._layers(player_position, max_step),
+                                 target_positions, self.shooting_cells)
+
+    def _cells(self, bits, x1, y1, x2, y2):
+        """flat indices (y * width + x) of the cells of bits, all within the rectangle"""
+        board = self.board
+        stride = board.stride
+        rows = y2 - y1 + 1
+        window = (bits >> (y1 * stride)) & ((1 << (rows * stride)) - 1)
+        raw = np.frombuffer(window.to_bytes((rows * stride + 7) // 8, "little"),
+                            dtype=np.uint8)
+        cells = np.unpackbits(raw, bitorder="little")[:rows * stride].reshape(
+            rows, stride)[:, x1:x2 + 1]
+        ys, xs = np.nonzero(cells)
+        return (ys + y1) * board.width + xs + x1
+
+    def exploration(self, player_position, player_action, max_step, heatmap):
+        """same as `BitBoard.exploration`, the heat is read on the visited cells only"""
+        key = (player_position, player_action)
+        walk = self.walks.get(key)
+        # (max_step, steps, known, unknown), reused with another max_step if
+        # the walk ended before both
+        if walk is None or (walk[0] != max_step and
+                            walk[1] >= min(walk[0], max_step)):
+            INCREMENTAL_RESULTS.inc("walk", "computed")
+            board = self.board
+            seen, steps = board.exploration_walk(player_position,
+                                                 player_action, max_step)
+            x, y = player_action.move(*player_position)
+            region = (max(0, x - max_step), max(0, y - max_step),
+                      min(board.width - 1, x + max_step),
+                      min(board.height - 1, y + max_step))
+            walk = (max_step, steps, self._cells(seen & board.free, *region),
+                    popcount(seen & board.unknown))
+            self.walks.put(key, [region], walk)
+        else:
+            INCREMENTAL_RESULTS.inc("walk", "cache")
+        _, _, known, unknown = walk
+        return {
+            "unknown": unknown,
+            "known": len(known),
+            "heat": np.minimum(20, heatmap.ravel()[known]).sum() + 20 * unknown
+        }
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Static analysis of a layout: tables that only depend on the walls, computed
+once per wall set and read in O(1) afterwards.
+
+    - degree: number of passable neighbours of each cell
+    - dead_end: cells of dead end branches, numbered from the tip (1) to the
+      cell next to the junction, 0 elsewhere
+    - corridor: passable cells with exactly two passable neighbours
+    - chokepoint: cells whose removal disconnects the passable cells
+      (articulation points)
+    - lanes: length of the clear line of sight from each cell in each
+      direction, as the rays of `BitBoard.ray`
+    - fan_out: number of cells seen from each cell, that is the number of
+      cells a shot can come from
+    - known: cells that are not unknown, the analysis is the one of a partial
+      map if some are unknown
+
+As in `RewardMaxStrategy.moves_to_target`, every cell but walls is passable.
+During a game only the walls seen so far are known, and they change with
+almost every turn: these analyses are only kept in memory. At the end of a
+game, what it knew of the map is stored in a cache directory, keyed by the
+size of the board, its walls and its known cells. A later game whose known
+cells agree with a stored map gets the analysis of the walls known by both
+games, and stores them in turn: games never explore a whole map, but maps
+get completed game after game.
+"""
+import hashlib
+from collections import OrderedDict, deque
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+
+from common import MOVEACTION
+from log import slog
+from metrics import timed
+from util import replace_file
+
+# order of the lanes
+LANE_ACTIONS = (MOVEACTION.UP, MOVEACTION.DOWN, MOVEACTION.LEFT,
+                MOVEACTION.RIGHT)
+TABLES = ("walls", "degree", "dead_end", "corridor", "chokepoint", "lanes",
+          "fan_out", "known")
+
+
+def layout_key(walls, known):
+    """
+    Args:
+        walls (np.array): (height, width) boolean array
+        known (np.array): (height, width) boolean array, cells that are not unknown
+    Returns:
+        key (str): <width>x<height>-<hash of walls and known cells>
+    """
+    height, width = walls.shape
+    digest = hashlib.sha1(np.packbits(walls).tobytes() +
+                          np.packbits(known).tobytes()).hexdigest()
+    return "{}x{}-{}".format(width, height, digest)
+
+
+def neighbour_counts(passable):
+    """number of passable neighbours of every cell"""
+    padded = np.pad(passable, 1, constant_values=False).astype(np.int8)
+    return (padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] +
+            padded[1:-1, 2:])
+
+
+def _neighbours(cell, width, size, passable):
+    """passable neighbours of a flat cell index"""
+    x = cell % width
+    for other in (cell - width, cell + width):
+        if 0 <= other < size and passable[other]:
+            yield other
+    if x > 0 and passable[cell - 1]:
+        yield cell - 1
+    if x < width - 1 and passable[cell + 1]:
+        yield cell + 1
+
+
+def dead_ends(passable, degree):
+    """
+    Prune cells with at most one neighbour left until none remains: pruned
+    cells are in dead end branches (or in tree shaped components)
+    """
+    height, width = passable.shape
+    size = height * width
+    flat = passable.ravel().tolist()
+    remaining = degree.ravel().tolist()
+    depth = [0] * size
+    queue = deque(int(c) for c in np.flatnonzero(passable & (degree <= 1)))
+    for cell in queue:
+        depth[cell] = 1
+    while queue:
+        cell = queue.popleft()
+        for other in _neighbours(cell, width, size, flat):
+            if depth[other]:
+                continue
+            remaining[other] -= 1
+            if remaining[other] <= 1:
+                depth[other] = depth[cell] + 1
+                queue.append(other)
+    return np.array(depth, dtype=np.int32).reshape(height, width)
+
+
+def articulation_points(passable):
+    """cells whose removal splits their connected component, with an iterative Tarjan dfs"""
+    height, width = passable.shape
+    size = height * width
+    flat = passable.ravel().tolist()
+    discovery = [0] * size
+    low = [0] * size
+    points = bytearray(size)
+    timer = 0
+    for root in range(size):
+        if not flat[root] or discovery[root]:
+            continue
+        timer += 1
+        discovery[root] = low[root] = timer
+        root_children = 0
+        # (cell, parent, neighbours left to visit)
+        stack = [(root, -1, _neighbours(root, width, size, flat))]
+        while stack:
+            cell, parent, neighbours = stack[-1]
+            for other in neighbours:
+                if not discovery[other]:
+                    timer += 1
+                    discovery[other] = low[other] = timer
+                    stack.append((other, cell,
+                                  _neighbours(other, width, size, flat)))
+                    break
+                if other != parent and discovery[other] < low[cell]:
+                    low[cell] = discovery[other]
+            else:
+                stack.pop()
+                if parent == -1:
+                    continue
+                if low[cell] < low[parent]:
+                    low[parent] = low[cell]
+                if parent == root:
+                    root_children += 1
+                elif low[cell] >= discovery[parent]:
+                    points[parent] = 1
+        if root_children > 1:
+            points[root] = 1
+    return np.frombuffer(bytes(points), dtype=np.uint8).astype(bool).reshape(
+        height, width)
+
+
+def lane_lengths(passable):
+    """
+    Returns:
+        lanes (np.array): (4, height, width), number of passable cells seen from
+            each cell in each direction of LANE_ACTIONS, up to a wall or the border
+    """
+    height, width = passable.shape
+    lanes = np.zeros((4, height, width), dtype=np.int32)
+    up, down, left, right = lanes
+    for y in range(1, height):
+        up[y] = np.where(passable[y - 1], up[y - 1] + 1, 0)
+    for y in range(height - 2, -1, -1):
+        down[y] = np.where(passable[y + 1], down[y + 1] + 1, 0)
+    for x in range(1, width):
+        left[:, x] = np.where(passable[:, x - 1], left[:, x - 1] + 1, 0)
+    for x in range(width - 2, -1, -1):
+        right[:, x] = np.where(passable[:, x + 1], right[:, x + 1] + 1, 0)
+    lanes[:, ~passable] = 0
+    return lanes
+
+
+class LayoutAnalysis:
+    def __init__(self, key, tables):
+        """
+        Args:
+            key (str): `layout_key` of the walls and known cells
+            tables (dict): {name -> array}, see TABLES
+        """
+        self.key = key
+        for name in TABLES:
+            setattr(self, name, tables[name])
+        self.height, self.width = self.walls.shape
+
+    @classmethod
+    @timed("layout.analyse")
+    def from_walls(cls, walls, known=None):
+        """
+        Args:
+            walls (np.array): (height, width) boolean array
+            known (np.array): (height, width) boolean array, cells that are not
+                unknown, default to all cells
+        """
+        if known is None:
+            known = np.ones(walls.shape, dtype=bool)
+        passable = ~walls
+        degree = neighbour_counts(passable)
+        degree[walls] = 0
+        lanes = lane_lengths(passable)
+        return cls(
+            layout_key(walls, known), {
+                "walls": walls.copy(),
+                "degree": degree,
+                "dead_end": dead_ends(passable, degree),
+                "corridor": passable & (degree == 2),
+                "chokepoint": articulation_points(passable),
+                "lanes": lanes,
+                "fan_out": lanes.sum(axis=0),
+                "known": known.copy()
+            })
+
+    @classmethod
+    def load(cls, path):
+        with np.load(str(path), allow_pickle=False) as data:
+            tables = {name: data[name] for name in TABLES}
+        return cls(Path(path).stem, tables)
+
+    def save(self, path):
+        replace_file(
+            Path(path),
+            lambda f: np.savez(f, **{name: getattr(self, name)
+                                     for name in TABLES}))
+
+    def lane(self, x, y, action):
+        """number of cells seen from (x, y) in the direction of action"""
+        return int(self.lanes[LANE_ACTIONS.index(action), y, x])
+
+    def long_lanes(self, min_length):
+        """cells that see at least min_length cells in some direction"""
+        return self.lanes.max(axis=0) >= min_length
+
+    def supersedes(self, other):
+        """True if the analysis knows every cell known by other, with the same walls"""
+        return (other.walls.shape == self.walls.shape and
+                not (other.known & ~self.known).any() and
+                np.array_equal(other.walls[other.known], self.walls[other.known]))
+
+
+class LayoutCache:
+    def __init__(self, root=None, max_layouts=16, max_files=64):
+        """
+        Args:
+            root (str): directory of stored maps, None to only keep them in memory
+            max_layouts (int): layouts of stored maps, and of the walls known
+                during games, kept in memory, the least recently used are dropped
+            max_files (int): maps kept in root, the oldest are deleted
+        """
+        self.root = Path(root) if root else None
+        self.max_layouts = max_layouts
+        self.max_files = max_files
+        # key -> LayoutAnalysis of a stored map
+        self._maps = OrderedDict()
+        # key -> LayoutAnalysis of the walls known during a game, kept apart so
+        # that they don't push maps out
+        self._partial = OrderedDict()
+        # environments of all board sizes share the cache
+        self._lock = Lock()
+
+    def _path(self, key):
+        return self.root / (key + ".npz")
+
+    def _remember(self, analysis, stored=False):
+        layouts = self._maps if stored else self._partial
+        with self._lock:
+            layouts[analysis.key] = analysis
+            layouts.move_to_end(analysis.key)
+            while len(layouts) > self.max_layouts:
+                layouts.popitem(last=False)
+
+    def get(self, walls, known):
+        """
+        LayoutAnalysis of walls, from memory, from a stored map or analysed
+        now (and only kept in memory, see `store`)
+
+        Args:
+            walls (np.array): (height, width) boolean array
+            known (np.array): (height, width) boolean array, cells that are not unknown
+        """
+        key = layout_key(walls, known)
+        stored = key in self._maps
+        analysis = self._maps.get(key) or self._partial.get(key)
+        if analysis is None and self.root is not None and self._path(key).exists():
+            try:
+                analysis = LayoutAnalysis.load(self._path(key))
+                stored = True
+            except (OSError, ValueError, KeyError) as e:
+                slog.log("WARNING", "Ignored layout {key}: {error}", key=key, error=e)
+        if analysis is None:
+            analysis = LayoutAnalysis.from_walls(walls, known)
+        self._remember(analysis, stored)
+        return analysis
+
+    def match(self, walls, known):
+        """
+        Stored map in memory with the same walls on the cells known by both
+        the map and a board. At least half of the cells known on the board must
+        be known by the map, a few cells could agree with any map.
+
+        Args:
+            walls (np.array): (height, width) boolean array, known walls
+            known (np.array): (height, width) boolean array, cells that are not unknown
+        Returns:
+            analysis (LayoutAnalysis): analysis of the map, None if no map agrees
+        """
+        with self._lock:
+            candidates = [a for a in reversed(self._maps.values())
+                          if a.walls.shape == walls.shape]
+        for analysis in candidates:
+            both = known & analysis.known
+            if (2 * np.count_nonzero(both) >= np.count_nonzero(known) and
+                    np.array_equal(analysis.walls[both], walls[both])):
+                self._remember(analysis, stored=True)
+                return analysis
+        return None
+
+    @timed("layout.store")
+    def store(self, analysis):
+        """
+        Keep the analysis of a map for later games on the same map, in root if
+        any. The maps it supersedes (see `LayoutAnalysis.supersedes`) are
+        dropped, the oldest maps are deleted beyond max_files.
+        """
+        with self._lock:
+            superseded = [key for key, a in self._maps.items()
+                          if key != analysis.key and analysis.supersedes(a)]
+            for key in superseded:
+                del self._maps[key]
+        self._remember(analysis, stored=True)
+        if self.root is None:
+            return
+        for key in superseded:
+            self._delete(self._path(key))
+        path = self._path(analysis.key)
+        if path.exists():
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        analysis.save(path)
+        paths = sorted(self.root.glob("*.npz"), key=lambda p: p.stat().st_mtime)
+        for old in paths[:max(0, len(paths) - self.max_files)]:
+            self._delete(old)
+
+    def _delete(self, path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            slog.log("WARNING", "Could not delete layout {path}: {error}",
+                     path=path, error=e)
+
+    @timed("layout.preload")
+    def preload(self, width, height):
+        """load the last stored maps of a board size in memory"""
+        if self.root is None or not self.root.is_dir():
+            return 0
+        paths = sorted(self.root.glob("{}x{}-*.npz".format(width, height)),
+                       key=lambda p: p.stat().st_mtime)[-self.max_layouts:]
+        for path in paths:
+            try:
+                self._remember(LayoutAnalysis.load(path), stored=True)
+            except (OSError, ValueError, KeyError) as e:
+                slog.log("WARNING", "Ignored layout {path}: {error}", path=path, error=e)
+        return len(paths)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Logging of the bot.
+
+Hot path code guards every record with `if slog.enabled:`, so nothing is
+built or formatted when logging is off. Messages are `str.format` templates
+over keyword fields, they are only formatted by loguru if the level passes.
+Records can also be kept as dicts in a ring buffer and flushed on error.
+"""
+import functools
+import os
+import sys
+import traceback
+from collections import deque
+from time import time
+
+from loguru import logger
+
+LOG_FORMAT = "{time}:{level}:{line}:{function}:{message}"
+LEVELS = {
+    "TRACE": 5,
+    "DEBUG": 10,
+    "INFO": 20,
+    "SUCCESS": 25,
+    "WARNING": 30,
+    "ERROR": 40,
+    "CRITICAL": 50,
+    "OFF": 100
+}
+
+
+class StructuredLog:
+    def __init__(self):
+        self.enabled = False
+        self.level_no = LEVELS["OFF"]
+        self.to_sink = False
+        self.records = None
+
+    def configure(self, level="INFO", sink="run.log", ring_size=0):
+        """
+        (Re)install the loguru sink
+
+        Args:
+            level (str): minimal level of records, "OFF" disables everything
+            sink (str): log file, None or "" to only keep the ring buffer
+            ring_size (int): number of structured records kept in memory, 0 to disable
+        """
+        level = level.upper()
+        logger.remove()
+        self.level_no = LEVELS[level]
+        self.to_sink = bool(sink) and level != "OFF"
+        if self.to_sink:
+            logger.add(sink, format=LOG_FORMAT, level=level)
+        self.records = deque(maxlen=ring_size) if ring_size > 0 else None
+        if not self.to_sink and self.records is not None:
+            # flushed records and errors still need to go somewhere
+            logger.add(sys.stderr, format=LOG_FORMAT, level="ERROR")
+        self.enabled = level != "OFF" and (self.to_sink
+                                           or self.records is not None)
+
+    def configure_from_env(self):
+        """Configure with AI_LOG_LEVEL, AI_LOG_FILE and AI_LOG_RING"""
+        self.configure(level=os.environ.get("AI_LOG_LEVEL", "INFO"),
+                       sink=os.environ.get("AI_LOG_FILE", "run.log"),
+                       ring_size=int(os.environ.get("AI_LOG_RING", "0")))
+
+    def enabled_for(self, level):
+        return self.enabled and LEVELS[level] >= self.level_no
+
+    def log(self, level, message, depth=0, **fields):
+        if LEVELS[level] < self.level_no:
+            return
+        if self.records is not None:
+            record = {"time": time(), "level": level, "template": message}
+            record.update(fields)
+            self.records.append(record)
+        if self.to_sink:
+            logger.opt(depth=depth + 1).log(level, message, **fields)
+
+    def exception(self, message, depth=0, **fields):
+        """ERROR record with the traceback of the exception being handled"""
+        if LEVELS["ERROR"] < self.level_no:
+            return
+        if self.records is not None:
+            record = {
+                "time": time(),
+                "level": "ERROR",
+                "template": message + "\n{traceback}",
+                "traceback": traceback.format_exc()
+            }
+            record.update(fields)
+            self.records.append(record)
+        if self.to_sink:
+            logger.opt(depth=depth + 1, exception=True).error(message, **fields)
+
+    def catch(self, function):
+        """decorator logging the exceptions raised by function, before raising them again"""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                self.exception("An error has been caught in function '{function}'",
+                               depth=1,
+                               function=function.__qualname__)
+                raise
+
+        return wrapper
+
+    def debug(self, message, **fields):
+        self.log("DEBUG", message, depth=1, **fields)
+
+    def info(self, message, **fields):
+        self.log("INFO", message, depth=1, **fields)
+
+    def flush(self):
+        """
+        Write all records of the ring buffer to the sink at ERROR level and empty it
+
+        Returns:
+            records (list(dict)): the flushed records
+        """
+        if self.records is None:
+            return []
+        records = list(self.records)
+        self.records.clear()
+        for record in records:
+            fields = {
+                k: v
+                for k, v in record.items()
+                if k not in ("time", "level", "template")
+            }
+            logger.error("[{level}] " + record["template"],
+                         level=record["level"],
+                         **fields)
+        return records
+
+
+slog = StructuredLog()
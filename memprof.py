@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory instrumentation of the bot process: sizes of the containers of each
+environment, and top allocators with tracemalloc.
+
+Tracing is opt-in as it slows down every allocation of the process: it is
+started by AI_TRACEMALLOC or by POST /debug/memory?trace=on. Snapshots of
+the allocations can be named and compared later, to check that memory stays
+flat between two points of a long session.
+"""
+import os
+import sys
+import tracemalloc
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+# attributes of the environment that grow or are sized by the board
+ENV_CONTAINERS = ("game_frame", "board_list", "board", "board_array",
+                  "board_heatmap", "turn_cache", "other_players", "enemies",
+                  "_bitboard", "_incremental", "_planner", "_layout")
+PLAYER_CONTAINERS = ("positions", "actions")
+# allocations of the instrumentation itself
+TRACE_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+
+def deep_size(obj):
+    """
+    Bytes used by obj and every object it references (containers, attributes),
+    each object being counted once
+
+    Args:
+        obj: any object
+    Returns:
+        size (int): bytes
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        if isinstance(current, np.ndarray):
+            # numpy doesn't count the buffer of views
+            size += sys.getsizeof(current) + (current.nbytes if current.base is not None else 0)
+            if current.dtype == object:
+                stack.extend(current.ravel().tolist())
+            continue
+        size += sys.getsizeof(current)
+        if isinstance(current, (str, bytes, int, float, bool, type(None))):
+            continue
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+        elif hasattr(current, "__dict__") and not isinstance(current, type):
+            stack.append(vars(current))
+    return size
+
+
+def _length(obj):
+    try:
+        return len(obj)
+    except TypeError:
+        return None
+
+
+def env_footprint(env):
+    """
+    Sizes of the containers of env
+
+    Returns:
+        footprint (dict): {"bytes": total, "containers": {name -> {"length", "bytes"}}}
+    """
+    containers = {}
+    for name in ENV_CONTAINERS:
+        value = getattr(env, name, None)
+        containers[name] = {"length": _length(value), "bytes": deep_size(value)}
+    if env.player is not None:
+        for name in PLAYER_CONTAINERS:
+            value = getattr(env.player, name)
+            containers["player." + name] = {
+                "length": _length(value),
+                "bytes": deep_size(value)
+            }
+    return {
+        # containers can share objects, the total is the size of all of them
+        "bytes": deep_size([getattr(env, name, None) for name in ENV_CONTAINERS] +
+                           [env.player]),
+        "containers": containers
+    }
+
+
+def rss_bytes():
+    """current resident memory of the process, None if unknown"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _statistics(statistics, limit):
+    return [{
+        "location": str(stat.traceback),
+        "bytes": stat.size,
+        "count": stat.count
+    } for stat in statistics[:limit]]
+
+
+def _differences(differences, limit):
+    return [{
+        "location": str(stat.traceback),
+        "bytes": stat.size,
+        "bytes_diff": stat.size_diff,
+        "count": stat.count,
+        "count_diff": stat.count_diff
+    } for stat in differences[:limit]]
+
+
+class MemoryProfiler:
+    GROUPS = ("lineno", "filename", "traceback")
+
+    def __init__(self, max_snapshots=8):
+        """
+        Args:
+            max_snapshots (int): named snapshots kept, the oldest ones are dropped
+        """
+        self.max_snapshots = max_snapshots
+        # name -> tracemalloc snapshot
+        self._snapshots = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=1):
+        """
+        Args:
+            frames (int): frames stored per allocation, more frames give
+                tracebacks of allocations but cost more
+        """
+        if not self.tracing:
+            tracemalloc.start(frames)
+
+    def stop(self):
+        """stop tracing, snapshots are dropped"""
+        tracemalloc.stop()
+        with self._lock:
+            self._snapshots.clear()
+
+    def traced(self):
+        """(current, peak) bytes allocated since tracing started"""
+        return tracemalloc.get_traced_memory() if self.tracing else None
+
+    def _take(self):
+        if not self.tracing:
+            raise RuntimeError("tracemalloc is not tracing")
+        return tracemalloc.take_snapshot().filter_traces(TRACE_FILTERS)
+
+    def snapshot(self, name):
+        """take a snapshot of the allocations, to compare with later"""
+        snapshot = self._take()
+        with self._lock:
+            self._snapshots.pop(name, None)
+            self._snapshots[name] = snapshot
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+
+    def snapshot_names(self):
+        with self._lock:
+            return list(self._snapshots)
+
+    def top(self, limit=10, group_by="lineno"):
+        """
+        Top allocators of the memory currently allocated
+
+        Args:
+            limit (int): number of allocators
+            group_by (str): "lineno", "filename" or "traceback"
+        Returns:
+            allocators (list(dict)): location, bytes and count of allocations
+        """
+        return _statistics(self._take().statistics(group_by), limit)
+
+    def diff(self, name, against=None, limit=10, group_by="lineno"):
+        """
+        Allocators that changed the most between two snapshots
+
+        Args:
+            name (str): name of the first snapshot
+            against (str): name of the second snapshot, default to now
+        Returns:
+            allocators (list(dict)): location, bytes and count, with their change
+        """
+        with self._lock:
+            if name not in self._snapshots or (against is not None and
+                                               against not in self._snapshots):
+                raise KeyError(against if name in self._snapshots else name)
+            first = self._snapshots[name]
+            second = self._snapshots[against] if against is not None else None
+        if second is None:
+            second = self._take()
+        return _differences(second.compare_to(first, group_by), limit)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-process metrics, exposed in prometheus text format by the `/metrics` endpoint
+"""
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+# upper bounds (in seconds) of the phase duration histograms
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+REGISTRY = []
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in pairs) + "}"
+
+
+class Metric:
+    TYPE = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+        REGISTRY.append(self)
+
+    def expose(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.TYPE)
+        ]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labelvalues, value in items:
+            lines.extend(self._expose_sample(labelvalues, value))
+        return lines
+
+    def _expose_sample(self, labelvalues, value):
+        return [
+            "{}{} {}".format(self.name,
+                             _format_labels(self.labelnames, labelvalues),
+                             value)
+        ]
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            # exposed as 0 before the first increment, so that rates have data
+            self._values[()] = 0
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues,
+                                                         0) + amount
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+
+class Histogram(Metric):
+    """
+    A histogram with fixed buckets, each observation costs a bisect
+    and a few increments under a lock.
+    """
+    TYPE = "histogram"
+
+    def __init__(self,
+                 name,
+                 documentation,
+                 labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            sample = self._values.get(labelvalues)
+            if sample is None:
+                # [counts per bucket (last one is +Inf), sum]
+                sample = [[0] * (len(self.buckets) + 1), 0.0]
+                self._values[labelvalues] = sample
+            sample[0][idx] += 1
+            sample[1] += value
+
+    def _expose_sample(self, labelvalues, value):
+        counts, total = value
+        lines = []
+        cumulated = 0
+        for bound, count in zip(self.buckets + ("+Inf", ), counts):
+            cumulated += count
+            lines.append("{}_bucket{} {}".format(
+                self.name,
+                _format_labels(self.labelnames, labelvalues,
+                               [("le", bound)]), cumulated))
+        labels = _format_labels(self.labelnames, labelvalues)
+        lines.append("{}_sum{} {}".format(self.name, labels, total))
+        lines.append("{}_count{} {}".format(self.name, labels, cumulated))
+        return lines
+
+
+def render():
+    """Text exposition of all registered metrics"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+PHASE_SECONDS = Histogram("ai_phase_duration_seconds",
+                          "Time spent in each phase of a move request",
+                          labelnames=("phase", ))
+MOVE_REQUESTS = Counter("ai_move_requests_total",
+                        "Number of /move requests received")
+STRATEGY_FALLBACKS = Counter(
+    "ai_strategy_fallbacks_total",
+    "Number of moves chosen by RandomStrategy after the main strategy failed")
+BOARD_SIZE = Gauge("ai_board_size", "Size of the current game board",
+                   labelnames=("dimension", ))
+INCREMENTAL_RESULTS = Counter(
+    "ai_incremental_results_total",
+    "Number of results of the incremental engine, by kind and origin (cache or computed)",
+    labelnames=("kind", "origin"))
+INCREMENTAL_RESETS = Counter(
+    "ai_incremental_resets_total",
+    "Number of times the incremental engine computed everything again")
+ENGINE_CHECKS = Counter(
+    "ai_engine_checks_total",
+    "Number of values compared between the reference and an optimized engine",
+    labelnames=("check", ))
+ENGINE_DIVERGENCES = Counter(
+    "ai_engine_divergences_total",
+    "Number of values that differ between the reference and an optimized engine",
+    labelnames=("check", ))
+
+
+def timed(phase):
+    """
+    Decorator recording the duration of each call in the phase histogram
+
+    Args:
+        phase (str): label value of the phase
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                PHASE_SECONDS.observe(perf_counter() - start, phase)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Occupancy probability fields: probability that an agent is at cell c after
+t moves, for t up to k.
+
+Transitions follow `Enemy.next_actions` and `Player.next_actions`: an enemy
+moves to one of its valid neighbour cells, a player also stays in place
+(invalid move, or one of the 4 shots if it can shoot), all actions being
+equally likely. One step is a 4-neighbour stencil applied to the fields of
+all agents at once, masked by walls.
+
+An agent never goes further than t cells in t moves, so the field of each
+agent is computed on a (2k + 1) x (2k + 1) window centered on its position:
+the cost is (number of agents) x k^3 whatever the size of the board.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from common import BoardState, FIREACTION, Player
+from metrics import timed
+
+
+def stay_weight(agent):
+    """number of actions that keep agent in place"""
+    if isinstance(agent, Player):
+        return 1 + (len(FIREACTION) if agent.can_shoot else 0)
+    # enemies always move
+    return 0
+
+
+def propagate(fields, valid, stay):
+    """
+    One move of every agent
+
+    Args:
+        fields (np.array): (agents, size, size) probabilities
+        valid (np.array): (agents, size + 2, size + 2) cells that can be
+            walked, with a margin of one cell around the fields
+        stay (np.array): (agents, ) number of actions keeping each agent in place
+    Returns:
+        fields (np.array): (agents, size, size) probabilities after the move
+    """
+    inner = valid[:, 1:-1, 1:-1]
+    neighbours = (valid[:, :-2, 1:-1].astype(np.int8) + valid[:, 2:, 1:-1] +
+                  valid[:, 1:-1, :-2] + valid[:, 1:-1, 2:])
+    actions = neighbours + stay[:, None, None]
+    share = np.divide(fields,
+                      actions,
+                      out=np.zeros_like(fields),
+                      where=actions > 0)
+    # an agent without any action doesn't disappear
+    moved = share * stay[:, None, None] + np.where(actions == 0, fields, 0)
+    moved[:, 1:, :] += share[:, :-1, :]
+    moved[:, :-1, :] += share[:, 1:, :]
+    moved[:, :, 1:] += share[:, :, :-1]
+    moved[:, :, :-1] += share[:, :, 1:]
+    return moved * inner
+
+
+class OccupancyField:
+    def __init__(self, board_array, agents, steps):
+        """
+        Args:
+            board_array (np.array): (height, width) array of BoardState values
+            agents (list(Agent)): agents to track
+            steps (int): number of moves k
+        """
+        self.height, self.width = board_array.shape
+        self.agents = list(agents)
+        self.steps = steps
+        self.size = 2 * steps + 1
+        # top left cell of the window of each agent, on the board
+        self.origins = np.array([(a.x - steps, a.y - steps)
+                                 for a in self.agents],
+                                dtype=np.intp).reshape(-1, 2)
+        # fields[t, i] is the window of agent i after t moves
+        self.fields = self._propagate(board_array)
+
+    @timed("occupancy.propagate")
+    def _propagate(self, board_array):
+        n_agents = len(self.agents)
+        fields = np.zeros((self.steps + 1, n_agents, self.size, self.size))
+        if not n_agents:
+            return fields
+        # as in `env.valid_pos`, unknown cells can be walked
+        margin = self.steps + 1
+        walkable = np.pad(board_array != BoardState.WALL.value,
+                          margin,
+                          constant_values=False)
+        windows = sliding_window_view(walkable, (self.size + 2, self.size + 2))
+        valid = windows[self.origins[:, 1] + margin - 1,
+                        self.origins[:, 0] + margin - 1]
+        stay = np.array([stay_weight(a) for a in self.agents], dtype=np.int8)
+        fields[0, :, self.steps, self.steps] = 1
+        for t in range(1, self.steps + 1):
+            fields[t] = propagate(fields[t - 1], valid, stay)
+        return fields
+
+    def probability(self, index, t, x, y):
+        """probability that agent `index` is at (x, y) after t moves"""
+        wx, wy = x - self.origins[index, 0], y - self.origins[index, 1]
+        if 0 <= wx < self.size and 0 <= wy < self.size:
+            return float(self.fields[t, index, wy, wx])
+        return 0.0
+
+    def positions(self, index, t):
+        """
+        Same as `Agent.next_positions` after t moves
+
+        Returns:
+            positions (list(tuple)): (x, y) the agent can be at
+            proba (list(float)): probability of each position
+        """
+        wys, wxs = np.nonzero(self.fields[t, index])
+        ox, oy = self.origins[index]
+        return ([(int(ox + wx), int(oy + wy)) for wx, wy in zip(wxs, wys)],
+                self.fields[t, index, wys, wxs].tolist())
+
+    def board_field(self, t, indices=None, combine="expected"):
+        """
+        Fields of some agents after t moves on the whole board
+
+        Args:
+            t (int): number of moves
+            indices (list(int)): agents to combine, default to all
+            combine (str): "expected" for the expected number of agents on each
+                cell, "any" for the probability that at least one is there
+                (agents being independent)
+        Returns:
+            field (np.array): (height, width) array
+        """
+        if combine not in ("expected", "any"):
+            raise ValueError("Unknown combination: {}".format(combine))
+        if indices is None:
+            indices = range(len(self.agents))
+        margin = self.steps
+        if combine == "expected":
+            padded = np.zeros((self.height + 2 * margin, self.width + 2 * margin))
+        else:
+            # probability that no agent is there
+            padded = np.ones((self.height + 2 * margin, self.width + 2 * margin))
+        for i in indices:
+            ox, oy = self.origins[i] + margin
+            window = padded[oy:oy + self.size, ox:ox + self.size]
+            if combine == "expected":
+                window += self.fields[t, i]
+            else:
+                window *= 1 - self.fields[t, i]
+        field = padded[margin:margin + self.height, margin:margin + self.width]
+        return field if combine == "expected" else 1 - field
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parallel evaluation of the next actions of player.
+
+Once per turn, the board, heatmap and agents are copied in shared memory
+blocks, reused from turn to turn while they are big enough. A persistent
+pool of worker processes then scores chunks of actions: each worker keeps
+its own environment per board size, synced from the shared blocks (only
+changed cells are rewritten), so the environment is never pickled. Tasks
+only carry block names, the player and the actions to score.
+"""
+import atexit
+import itertools
+import multiprocessing
+import weakref
+from multiprocessing import shared_memory
+from threading import Lock
+
+import numpy as np
+
+from common import Enemy, Player
+from metrics import timed
+
+# columns of the agents block
+AGENT_FIELDS = 4
+KIND_PLAYER, KIND_ENEMY = 0, 1
+
+
+def _chunks(indices, n):
+    """split indices in at most n contiguous chunks of similar sizes"""
+    n = max(1, min(n, len(indices)))
+    size, extra = divmod(len(indices), n)
+    chunks, start = [], 0
+    for i in range(n):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(indices[start:end])
+        start = end
+    return chunks
+
+
+class ParallelEvaluator:
+    def __init__(self, processes, min_cells=0, engines=("python",)):
+        """
+        Args:
+            processes (int): number of worker processes
+            min_cells (int): smaller boards are evaluated in the main process,
+                as the evaluation doesn't pay for the dispatch
+            engines (tuple): board engines worth dispatching, the others are
+                evaluated in the main process. Workers rebuild their bitboard
+                from the shared board every turn, which costs more than the
+                bitboard and incremental evaluations themselves
+        """
+        self.processes = processes
+        self.min_cells = min_cells
+        self.engines = tuple(engines)
+        self._pool = None
+        # block name -> SharedMemory
+        self._blocks = {}
+        # weak reference to the env of the published turn, with its (step, board version)
+        self._env = None
+        self._turn = None
+        self._shared = None
+        # numbers of the published turns, workers only compare these
+        self._publications = itertools.count()
+        self._lock = Lock()
+        atexit.register(self.close)
+
+    def start(self):
+        """start the worker pool, if not done yet"""
+        if self._pool is None:
+            # spawn: forking a threaded server is not safe
+            context = multiprocessing.get_context("spawn")
+            self._pool = context.Pool(self.processes,
+                                      initializer=_init_worker)
+        return self
+
+    def worth_it(self, strategy):
+        env = strategy.env
+        return strategy.engine in self.engines \
+            and env.board_width * env.board_height >= self.min_cells
+
+    def _block(self, role, array):
+        """copy array in the shared block of this role, (re)allocated if too small"""
+        block = self._blocks.get(role)
+        if block is None or block.size < max(1, array.nbytes):
+            if block is not None:
+                block.close()
+                block.unlink()
+            block = shared_memory.SharedMemory(create=True,
+                                               size=max(1, array.nbytes))
+            self._blocks[role] = block
+        np.ndarray(array.shape, dtype=array.dtype,
+                   buffer=block.buf)[...] = array
+        return (block.name, array.shape, array.dtype.str)
+
+    def _publish(self, env):
+        """copy the state of the turn in shared memory, once per turn"""
+        # ids of freed environments are reused, their identity is checked instead
+        turn = (env.step, env.board_version)
+        if self._env is not None and self._env() is env and turn == self._turn:
+            return self._shared
+        agents = np.zeros((len(env.other_players) + len(env.enemies),
+                           AGENT_FIELDS),
+                          dtype=np.int32)
+        # same order as RewardMaxStrategy.next_actions_of_others
+        for i, p in enumerate(env.other_players):
+            agents[i] = (p.x, p.y, KIND_PLAYER, 0)
+        offset = len(env.other_players)
+        for i, e in enumerate(env.enemies):
+            agents[offset + i] = (e.x, e.y, KIND_ENEMY, e.is_neutral)
+        self._shared = {
+            "turn": next(self._publications),
+            "board": self._block("board", env.board_array),
+            "heatmap": self._block("heatmap", env.board_heatmap),
+            "agents": self._block("agents", agents),
+            "player": (env.player.x, env.player.y, env.player.can_shoot),
+            "exploration_max_step": env.exploration_max_step
+        }
+        self._env = weakref.ref(env)
+        self._turn = turn
+        return self._shared
+
+    def _map(self, strategy, kind, actions):
+        shared = self._publish(strategy.env)
+        options = {
+            "engine": strategy.engine,
+            "long_range": strategy.long_range
+        }
+        tasks = [(shared, options, kind, actions, chunk)
+                 for chunk in _chunks(list(range(len(actions))),
+                                      self.processes)]
+        rewards = []
+        for chunk_rewards in self.start()._pool.map(_evaluate, tasks):
+            rewards.extend(chunk_rewards)
+        return rewards
+
+    @timed("parallel.combat_rewards")
+    def combat_rewards(self, strategy, player_actions):
+        """same as `strategy.combat_rewards(player_actions)`"""
+        with self._lock:
+            return self._map(strategy, "combat", player_actions)
+
+    @timed("parallel.exploration_rewards")
+    def exploration_rewards(self, strategy, player_actions):
+        """`strategy.exploration_reward` of each action"""
+        with self._lock:
+            return self._map(strategy, "exploration", player_actions)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        for block in self._blocks.values():
+            block.close()
+            block.unlink()
+        self._blocks = {}
+        self._env = None
+        self._turn = None
+
+
+# state of a worker process
+# role -> SharedMemory attached for this role ("board", "heatmap" or "agents")
+_attached = {}
+# (width, height) -> [environment, turn it is synced with]
+_worker_envs = {}
+
+
+def _init_worker():
+    from log import slog
+    slog.configure(level="OFF")
+
+
+def _attach(role, spec):
+    """array of the shared block of role, the block previously attached for it is closed"""
+    name, shape, dtype = spec
+    block = _attached.get(role)
+    if block is None or block.name != name:
+        if block is not None:
+            # reallocated (and unlinked) by the main process for a bigger board,
+            # no array of a previous turn is left on it
+            block.close()
+        block = shared_memory.SharedMemory(name=name)
+        _attached[role] = block
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def _worker_env(shared):
+    """environment of this worker for the board size, synced with the shared turn"""
+    from env import RecurrentEnvironment
+
+    board = _attach("board", shared["board"])
+    height, width = board.shape
+    synced = _worker_envs.get((width, height))
+    if synced is None:
+        synced = [RecurrentEnvironment(), None]
+        _worker_envs[(width, height)] = synced
+    env = synced[0]
+    if synced[1] != shared["turn"]:
+        synced[1] = shared["turn"]
+        env.set_board(board)
+        env.board_heatmap[...] = _attach("heatmap", shared["heatmap"])
+        env.turn_cache.clear()
+        env.exploration_max_step = shared["exploration_max_step"]
+        x, y, can_shoot = shared["player"]
+        env.player = Player(x=x, y=y, can_shoot=can_shoot)
+        agents = _attach("agents", shared["agents"]).tolist()
+        env.other_players = [
+            Player(x=ax, y=ay) for ax, ay, kind, _ in agents if kind == KIND_PLAYER
+        ]
+        env.enemies = [
+            Enemy(x=ax, y=ay, is_neutral=bool(neutral))
+            for ax, ay, kind, neutral in agents if kind == KIND_ENEMY
+        ]
+    return env
+
+
+def _evaluate(task):
+    from ai import RewardMaxStrategy
+
+    shared, options, kind, actions, indices = task
+    strategy = RewardMaxStrategy(_worker_env(shared), **options)
+    if kind == "combat":
+        return strategy.combat_rewards(actions, indices)
+    return [strategy.exploration_reward(actions[i]) for i in indices]
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Hierarchical path planning (HPA*) for long range distances on large boards.
+
+The board is split in square clusters. Where two neighbour clusters touch,
+every run of cells that are passable on both sides gets one or two
+entrances: pairs of nodes linked by one move. Inside a cluster, entrances are linked by their
+bfs distance in the cluster. A distance query connects the source and the
+target to the entrances of their clusters, then runs A* on the abstract
+graph. The last results are cached until the walls change.
+
+As in `RewardMaxStrategy.moves_to_target`, every cell but walls (known or
+unknown) is passable, so only new walls change the graph. Distances are
+near-optimal, as paths have to go through entrances.
+"""
+import heapq
+from collections import OrderedDict
+
+from bitboard import BitBoard
+from common import BoardState
+from metrics import timed
+
+# passable runs of a border with an entrance at both ends
+LONG_RUN = 6
+
+
+def manhattan(a, b):
+    return abs(a[0] - b[0]) + abs(a[1] - b[1])
+
+
+class HierarchicalPlanner:
+    def __init__(self, board_array, cluster_size=10, max_distances=4096):
+        """
+        Args:
+            board_array (np.array): (height, width) array of BoardState values, kept
+                as a reference: changes must be reported with `mark_changed`
+            cluster_size (int): width and height of clusters
+            max_distances (int): distances kept, the least recently used are dropped
+        """
+        self.board_array = board_array
+        self.height, self.width = board_array.shape
+        self.cluster_size = cluster_size
+        self.n_cluster_x = -(-self.width // cluster_size)
+        self.n_cluster_y = -(-self.height // cluster_size)
+        # (cluster, right or bottom neighbour) -> [(cell in cluster, cell in neighbour)]
+        self.borders = {}
+        # cluster -> {entrance -> {entrance -> distance inside cluster}}
+        self.intra = {}
+        # entrance -> set(entrances of neighbour clusters one move away)
+        self.links = {}
+        # clusters without any wall, distances are manhattan distances there
+        self.open_clusters = set()
+        # cluster -> BitBoard of the cluster, for local bfs
+        self._cluster_boards = {}
+        # (source, target) -> distance, until the walls change
+        self._distances = OrderedDict()
+        self.max_distances = max_distances
+        self._walls = None
+        self._dirty = {(cx, cy)
+                       for cx in range(self.n_cluster_x)
+                       for cy in range(self.n_cluster_y)}
+
+    def cluster_of(self, x, y):
+        return (x // self.cluster_size, y // self.cluster_size)
+
+    def cluster_bounds(self, cluster):
+        """(x1, y1, x2, y2) of cluster, x2 and y2 excluded"""
+        x1, y1 = cluster[0] * self.cluster_size, cluster[1] * self.cluster_size
+        return (x1, y1, min(self.width, x1 + self.cluster_size),
+                min(self.height, y1 + self.cluster_size))
+
+    def passable(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height \
+            and self.board_array[y, x] != BoardState.WALL.value
+
+    def mark_changed(self, cells):
+        """
+        Args:
+            cells (iterable(tuple)): (x, y) of cells that became or stopped being walls
+        """
+        for x, y in cells:
+            self._dirty.add(self.cluster_of(x, y))
+
+    def _neighbour_clusters(self, cluster):
+        cx, cy = cluster
+        for nx, ny in ((cx + 1, cy), (cx - 1, cy), (cx, cy + 1), (cx, cy - 1)):
+            if 0 <= nx < self.n_cluster_x and 0 <= ny < self.n_cluster_y:
+                yield (nx, ny)
+
+    def _border_entrances(self, cluster, neighbour):
+        """
+        one entrance in the middle of every passable run of the border,
+        or one at each end of long runs
+        """
+        x1, y1, x2, y2 = self.cluster_bounds(cluster)
+        if neighbour[0] > cluster[0]:
+            cells = [((x2 - 1, y), (x2, y)) for y in range(y1, y2)]
+            open_pairs = ~(self._walls[y1:y2, x2 - 1] | self._walls[y1:y2, x2])
+        else:
+            cells = [((x, y2 - 1), (x, y2)) for x in range(x1, x2)]
+            open_pairs = ~(self._walls[y2 - 1, x1:x2] | self._walls[y2, x1:x2])
+        entrances = []
+        run = []
+        for pair, is_open in zip(cells + [None], open_pairs.tolist() + [False]):
+            if is_open:
+                run.append(pair)
+                continue
+            if len(run) >= LONG_RUN:
+                entrances.extend([run[0], run[-1]])
+            elif run:
+                entrances.append(run[len(run) // 2])
+            run = []
+        return entrances
+
+    def _set_border(self, key, entrances):
+        for a, b in self.borders.get(key, []):
+            self.links.get(a, set()).discard(b)
+            self.links.get(b, set()).discard(a)
+        self.borders[key] = entrances
+        for a, b in entrances:
+            self.links.setdefault(a, set()).add(b)
+            self.links.setdefault(b, set()).add(a)
+
+    def entrances(self, cluster):
+        nodes = set()
+        for neighbour in self._neighbour_clusters(cluster):
+            if neighbour > cluster:
+                nodes.update(a for a, _ in self.borders.get((cluster, neighbour), []))
+            else:
+                nodes.update(b for _, b in self.borders.get((neighbour, cluster), []))
+        return nodes
+
+    def local_distances(self, cluster, start, targets):
+        """
+        bfs distances from start to some cells of cluster, without leaving it
+
+        Args:
+            cluster (tuple): cluster of start
+            start (tuple): (x, y)
+            targets (iterable(tuple)): cells of the cluster we need the distance of
+        Returns:
+            distances (dict): {cell -> distance}, unreachable cells are missing
+        """
+        if cluster in self.open_clusters:
+            return {cell: manhattan(start, cell) for cell in targets}
+        x1, y1, x2, y2 = self.cluster_bounds(cluster)
+        board = self._cluster_boards.get(cluster)
+        if board is None:
+            board = BitBoard(self.board_array[y1:y2, x1:x2])
+            self._cluster_boards[cluster] = board
+        layers = board.bfs_layers(board.bit(start[0] - x1, start[1] - y1),
+                                  (x2 - x1) * (y2 - y1))
+        cells = {board.bit(x - x1, y - y1): (x, y) for x, y in targets}
+        remaining = 0
+        for bit in cells:
+            remaining |= bit
+        distances = {}
+        for step, layer in enumerate(layers):
+            found = layer & remaining
+            while found:
+                bit = found & -found
+                distances[cells[bit]] = step
+                found ^= bit
+            remaining &= ~layer
+            if not remaining:
+                break
+        return distances
+
+    @timed("planner.rebuild")
+    def _rebuild(self):
+        if not self._dirty:
+            return
+        self._walls = self.board_array == BoardState.WALL.value
+        touched = set(self._dirty)
+        for cluster in self._dirty:
+            self._cluster_boards.pop(cluster, None)
+            x1, y1, x2, y2 = self.cluster_bounds(cluster)
+            if self._walls[y1:y2, x1:x2].any():
+                self.open_clusters.discard(cluster)
+            else:
+                self.open_clusters.add(cluster)
+            for neighbour in self._neighbour_clusters(cluster):
+                key = (cluster, neighbour) if neighbour > cluster else (neighbour, cluster)
+                self._set_border(key, self._border_entrances(*key))
+                touched.add(neighbour)
+        for cluster in touched:
+            nodes = self.entrances(cluster)
+            self.intra[cluster] = {}
+            for node in nodes:
+                distances = self.local_distances(cluster, node, nodes)
+                self.intra[cluster][node] = {
+                    other: distances[other]
+                    for other in nodes if other != node and other in distances
+                }
+        self._dirty = set()
+        self._distances.clear()
+
+    def distance(self, source, target):
+        """
+        Approximate number of moves from source to target
+
+        Args:
+            source (tuple): (x, y)
+            target (tuple): (x, y)
+        Returns:
+            moves (int): None if target cannot be reached
+        """
+        if not (self.passable(*source) and self.passable(*target)):
+            return None
+        self._rebuild()
+        key = (source, target)
+        if key in self._distances:
+            self._distances.move_to_end(key)
+            return self._distances[key]
+        moves = self._search(source, target)
+        self._distances[key] = moves
+        if len(self._distances) > self.max_distances:
+            self._distances.popitem(last=False)
+        return moves
+
+    def _search(self, source, target):
+        """
+        A* over the abstract graph, from the entrances reachable from source
+        to the entrances target is reachable from. Manhattan distance to target
+        is a consistent heuristic as every edge costs at least the manhattan
+        distance between its ends.
+        """
+        source_cluster = self.cluster_of(*source)
+        target_cluster = self.cluster_of(*target)
+        source_entrances = self.entrances(source_cluster)
+        target_entrances = self.entrances(target_cluster)
+        wanted = set(source_entrances)
+        if source_cluster == target_cluster:
+            wanted.add(target)
+        from_source = self.local_distances(source_cluster, source, wanted)
+        to_target = self.local_distances(target_cluster, target,
+                                         target_entrances)
+        best = from_source.get(target)
+
+        # heap of (estimated total cost, estimated remaining cost, node): on ties,
+        # nodes closer to target first
+        costs = {}
+        heap = []
+        for node in source_entrances:
+            if node in from_source:
+                costs[node] = from_source[node]
+                remaining = manhattan(node, target)
+                heapq.heappush(heap, (costs[node] + remaining, remaining, node))
+        while heap:
+            estimate, remaining, node = heapq.heappop(heap)
+            if best is not None and estimate >= best:
+                break
+            cost = costs[node]
+            if estimate > cost + remaining:
+                continue
+            if node in to_target:
+                if best is None or cost + to_target[node] < best:
+                    best = cost + to_target[node]
+            edges = list(self.intra[self.cluster_of(*node)].get(node, {}).items())
+            edges += [(other, 1) for other in self.links.get(node, ())]
+            for other, edge_cost in edges:
+                if cost + edge_cost < costs.get(other, float("inf")):
+                    costs[other] = cost + edge_cost
+                    remaining = manhattan(other, target)
+                    heapq.heappush(heap, (costs[other] + remaining, remaining, other))
+        return best
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ASCII rendering of the environment, only done on demand (debug endpoint,
+recorded boards or DEBUG logs) as it costs O(board area) per call.
+"""
+import numpy as np
+
+from common import BoardState
+
+# indexed by BoardState value
+CELL_CHARS = np.frombuffer(b"X_#", dtype=np.uint8)
+# heat is capped at 20 in the exploration reward
+HEAT_CHARS = np.frombuffer(b"0123456789abcdefghijk", dtype=np.uint8)
+MAX_HEAT = len(HEAT_CHARS) - 1
+CELL_SEP = b"  "
+
+
+def _overlay_agents(chars, env):
+    for p in env.other_players:
+        chars[p.y, p.x] = ord("P")
+    for e in env.enemies:
+        chars[e.y, e.x] = ord("O") if e.is_neutral else ord("E")
+    if env.player is not None:
+        chars[env.player.y, env.player.x] = ord("M")
+    return chars
+
+
+def _to_text(chars):
+    """
+    Join a (height, width) array of ascii codes into rows of cells
+    separated by two spaces, without any per-cell python work
+    """
+    height, width = chars.shape
+    cell_width = 1 + len(CELL_SEP)
+    out = np.full((height, width * cell_width - len(CELL_SEP) + 1),
+                  ord(" "),
+                  dtype=np.uint8)
+    out[:, 0:-1:cell_width] = chars
+    out[:, -1] = ord("\n")
+    return out.tobytes().decode("ascii")[:-1]
+
+
+def render_board(env):
+    """
+    Board with agents overlaid:
+        X: unknown, _: free, #: wall
+        M: player, P: other players, O: neutral enemies, E: hostile enemies
+    """
+    chars = CELL_CHARS[env.board_array]
+    return _to_text(_overlay_agents(chars, env))
+
+
+def render_heatmap(env):
+    """
+    Heat of each cell (steps since the player was there), capped at 20 and
+    written in base 21 (0-9 then a-k), walls are kept as #
+    """
+    heat = np.clip(env.board_heatmap, 0, MAX_HEAT).astype(np.intp)
+    chars = HEAT_CHARS[heat]
+    chars[env.board_array == BoardState.WALL.value] = ord("#")
+    return _to_text(chars)
+
+
+def render_layout(analysis):
+    """
+    Static features of a LayoutAnalysis:
+        #: wall, C: chokepoint, D: dead end, =: corridor, _: other cells
+    """
+    chars = np.full(analysis.walls.shape, ord("_"), dtype=np.uint8)
+    chars[analysis.corridor] = ord("=")
+    chars[analysis.dead_end > 0] = ord("D")
+    chars[analysis.chokepoint] = ord("C")
+    chars[analysis.walls] = ord("#")
+    return _to_text(chars)
+
+
+def render_rewards(rewards):
+    """
+    Args:
+        rewards (dict): {reward name -> [(action, reward)]}, see `RewardMaxStrategy.last_rewards`
+    """
+    lines = []
+    for name, action_rewards in rewards.items():
+        lines.append("{}:".format(name))
+        for action, reward in action_rewards:
+            lines.append("  {:<12}{:>12.3f}".format(str(action), reward))
+    return "\n".join(lines)
@@ -1,9 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from ai import RandomStrategy, RewardMaxStrategy
-from env import RecurrentEnvironment, RecordEnvironement
+from divergence import DiffChecker
+from env import RecurrentEnvironment, RecordEnvironement, prune_snapshots
+from layout import LayoutCache
+from log import slog
+from memprof import MemoryProfiler, env_footprint, rss_bytes
+from render import render_board, render_heatmap, render_layout, render_rewards
+from metrics import (BOARD_SIZE, MOVE_REQUESTS, STRATEGY_FALLBACKS, render,
+                     timed)
+from pathlib import Path
+from threading import Lock
+import argparse
+import attr
+import os
+import signal
 import sys
 
 USER = "slong"
@@ -15,9 +28,159 @@ server = Flask("AiServer-{tag}".format(tag=TAG))
 #  env = RecordEnvironement()
 #  strategy = RandomStrategy(env)
 
-env = RecurrentEnvironment()
-optim_strategy = RewardMaxStrategy(env)
-random_strategy = RandomStrategy(env)
+# snapshots of the environment, to restart in the middle of a game
+SNAPSHOT_DIR = os.environ.get("AI_SNAPSHOT_DIR", "snapshots")
+# save a snapshot every n steps, 0 to only save on SIGUSR1/SIGTERM
+SNAPSHOT_EVERY = int(os.environ.get("AI_SNAPSHOT_EVERY", "10"))
+# snapshots kept, the oldest games are deleted
+SNAPSHOT_MAX = int(os.environ.get("AI_SNAPSHOT_MAX", "16"))
+# worker processes scoring the next actions, 0 to score them in the server process
+WORKERS = int(os.environ.get("AI_WORKERS", "0"))
+# smaller boards are scored in the server process
+PARALLEL_MIN_CELLS = int(os.environ.get("AI_PARALLEL_MIN_CELLS", "0"))
+# board engines scored by the workers, the others in the server process
+PARALLEL_ENGINES = os.environ.get("AI_PARALLEL_ENGINES", "python").split(",")
+
+# board engine of the bots, can be switched with /debug/engine
+_engine = os.environ.get("AI_BOARD_ENGINE", "python")
+# analysed layouts of fully explored maps, for later games on the same map,
+# empty to keep them in memory
+LAYOUT_CACHE = os.environ.get("AI_LAYOUT_CACHE", "layouts")
+# frames per allocation traced by tracemalloc, 0 to not trace (see /debug/memory)
+TRACEMALLOC = int(os.environ.get("AI_TRACEMALLOC", "0"))
+
+# engine computing each move again to compare with, None to disable
+_shadow_engine = os.environ.get("AI_SHADOW_ENGINE") or None
+
+
+@attr.s
+class Bot:
+    """environment and strategies playing on boards of one size"""
+    env = attr.ib()
+    optim_strategy = attr.ib()
+    random_strategy = attr.ib()
+    # same strategy with the shadow engine, see `divergence.py`
+    shadow_strategy = attr.ib(default=None)
+
+
+# nothing is built at import time, see `setup` and `get_bot`
+_setup_done = False
+_bots = {}
+_bots_lock = Lock()
+# bot of the last move, for debug endpoints
+_current_bot = None
+# shared by all bots, see `setup`
+_evaluator = None
+# divergences between the bots and their shadow strategies
+_checker = DiffChecker(max_divergences=100)
+_profiler = MemoryProfiler()
+_layout_cache = LayoutCache(LAYOUT_CACHE or None)
+
+
+def setup():
+    """process wide initialization, done once before the first bot is built"""
+    global _setup_done, _evaluator
+    if not _setup_done:
+        slog.configure_from_env()
+        if WORKERS > 0:
+            # shared memory needs python 3.8, only imported with workers
+            from parallel import ParallelEvaluator
+            _evaluator = ParallelEvaluator(WORKERS, PARALLEL_MIN_CELLS,
+                                           PARALLEL_ENGINES)
+        if TRACEMALLOC > 0:
+            _profiler.start(TRACEMALLOC)
+        _setup_done = True
+
+
+def get_bot(width, height):
+    """
+    Bot for boards of size width x height, built on first use
+    """
+    key = (width, height)
+    bot = _bots.get(key)
+    if bot is None:
+        with _bots_lock:
+            bot = _bots.get(key)
+            if bot is None:
+                setup()
+                env = RecurrentEnvironment(
+                    record_boards=os.environ.get("AI_RECORD_BOARDS", "0") == "1",
+                    layout_cache=_layout_cache)
+                optim_strategy = RewardMaxStrategy(
+                    env,
+                    engine=_engine,
+                    long_range=os.environ.get("AI_LONG_RANGE", "0") == "1",
+                    evaluator=_evaluator)
+                bot = Bot(env, optim_strategy, RandomStrategy(env))
+                set_shadow(bot, _shadow_engine)
+                _bots[key] = bot
+    return bot
+
+
+def set_shadow(bot, engine):
+    """compare the moves of bot with the same strategy on another engine, None to stop"""
+    if engine is None:
+        bot.shadow_strategy = None
+        return
+    bot.shadow_strategy = RewardMaxStrategy(
+        bot.env,
+        engine=engine,
+        long_range=bot.optim_strategy.long_range)
+
+
+@timed("server.warm_up")
+def warm_up(sizes):
+    """
+    Build the bots of the given board sizes and precompute the tables that
+    only depend on the layout, to be done before the port is opened
+
+    Args:
+        sizes (list(tuple)): list of (width, height)
+    """
+    for width, height in sizes:
+        get_bot(width, height).env.warm_up(width, height)
+    if sizes and _evaluator is not None:
+        # workers take a while to spawn and import numpy
+        _evaluator.start()
+
+
+def restore_game(env, state):
+    """
+    restore the snapshot of a game the first time we see it in this process,
+    after storing the layout of the previous game
+    """
+    game_id = state.get("game", {}).get("id")
+    if game_id is None or game_id == env.game_id:
+        return
+    if env.game_id is not None:
+        # the previous game is over
+        env.store_layout()
+    size = state["board"]["size"]
+    if env.load_snapshot(SNAPSHOT_DIR, game_id,
+                         (size["width"], size["height"])):
+        slog.log("WARNING", "Restored snapshot of game {game_id} at step {step}",
+                 game_id=game_id,
+                 step=env.step)
+
+
+def save_snapshot(signum=None, frame=None):
+    for bot in list(_bots.values()):
+        bot.env.save_snapshot(SNAPSHOT_DIR)
+        bot.env.store_layout()
+    prune_snapshots(SNAPSHOT_DIR, SNAPSHOT_MAX)
+    if signum == signal.SIGTERM:
+        sys.exit(0)
+
+
+def save_games(prefix="."):
+    """save game frames and boards of every bot, in a sub directory per size if there are many"""
+    for (width, height), bot in list(_bots.items()):
+        path = Path(prefix)
+        if len(_bots) > 1:
+            path = path / "{}x{}".format(width, height)
+            path.mkdir(parents=True, exist_ok=True)
+        bot.env.save(str(path))
+
 
 @server.route("/name", methods=["POST"])
 def get_username():
@@ -25,21 +188,163 @@ def get_username():
 
 
 @server.route("/move", methods=["POST"])
+@timed("request.move")
 def next_move():
+    global _current_bot
+    MOVE_REQUESTS.inc()
     state = request.get_json()
+    size = state["board"]["size"]
+    bot = get_bot(size["width"], size["height"])
+    _current_bot = bot
+    env = bot.env
+    restore_game(env, state)
     env.update(state)
+    BOARD_SIZE.set(env.board_width, "width")
+    BOARD_SIZE.set(env.board_height, "height")
     try:
-        best_move = optim_strategy.best_action()
+        if bot.shadow_strategy is None:
+            best_move = bot.optim_strategy.best_action()
+        else:
+            best_move = _checker.compare_best_actions(
+                bot.shadow_strategy,
+                bot.optim_strategy,
+                "game {} step {}".format(env.game_id, env.step - 1),
+                play=bot.optim_strategy)
     except Exception:
-        best_move = random_strategy.best_action()
+        STRATEGY_FALLBACKS.inc()
+        slog.flush()
+        best_move = bot.random_strategy.best_action()
     env.update_after_player_action(best_move)
+    if SNAPSHOT_EVERY > 0 and env.step % SNAPSHOT_EVERY == 0:
+        env.save_snapshot(SNAPSHOT_DIR)
+        prune_snapshots(SNAPSHOT_DIR, SNAPSHOT_MAX)
     return jsonify(move=best_move)
 
 
+@server.route("/debug/board", methods=["GET"])
+def debug_board():
+    bot = _current_bot
+    if bot is None or bot.env.board_array is None:
+        return Response("No game yet\n", mimetype="text/plain", status=404)
+    parts = [render_board(bot.env)]
+    if request.args.get("heatmap") == "1":
+        parts.append(render_heatmap(bot.env))
+    if request.args.get("layout") == "1":
+        parts.append(render_layout(bot.env.layout()))
+    if request.args.get("rewards") == "1":
+        parts.append(render_rewards(bot.optim_strategy.last_rewards))
+    return Response("\n\n".join(parts) + "\n", mimetype="text/plain")
+
+
+@server.route("/debug/engine", methods=["GET", "POST"])
+def debug_engine():
+    """
+    GET: engines and last divergences
+    POST: switch engines of all bots, with ?engine=<engine> and/or ?shadow=<engine|off>
+    """
+    global _engine, _shadow_engine
+    if request.method == "POST":
+        engine = request.args.get("engine", _engine)
+        shadow = request.args.get("shadow", _shadow_engine or "off")
+        shadow = None if shadow == "off" else shadow
+        for name in (engine, shadow):
+            if name is not None and name not in RewardMaxStrategy.ENGINES:
+                return jsonify(error="Unknown board engine: {}".format(name)), 400
+        with _bots_lock:
+            _engine, _shadow_engine = engine, shadow
+            for bot in _bots.values():
+                bot.optim_strategy.set_engine(engine)
+                set_shadow(bot, shadow)
+    return jsonify(engine=_engine,
+                   shadow=_shadow_engine,
+                   checks=dict(_checker.checks),
+                   diverged=dict(_checker.diverged),
+                   divergences=[str(d) for d in _checker.divergences])
+
+
+@server.route("/debug/memory", methods=["GET", "POST"])
+def debug_memory():
+    """
+    GET: resident memory, footprint of each bot and, when tracing, top allocators
+        ?top=<n>: number of allocators, default 10
+        ?group=<lineno|filename|traceback>: grouping of allocations, default lineno
+        ?diff=<name>[&against=<name>]: allocators that changed the most since a snapshot
+    POST: ?trace=<on|off>[&frames=<n>] to start or stop tracing,
+        ?snapshot=<name> to take a named snapshot
+    """
+    try:
+        limit = int(request.args.get("top", "10"))
+        frames = int(request.args.get("frames", "1"))
+    except ValueError:
+        return jsonify(error="top and frames must be integers"), 400
+    if limit < 0 or frames < 1:
+        return jsonify(error="top must be >= 0 and frames >= 1"), 400
+    group_by = request.args.get("group", "lineno")
+    if group_by not in MemoryProfiler.GROUPS:
+        return jsonify(error="Unknown group: {}".format(group_by)), 400
+
+    if request.method == "POST":
+        trace = request.args.get("trace")
+        if trace == "on":
+            _profiler.start(frames)
+        elif trace == "off":
+            _profiler.stop()
+        if "snapshot" in request.args:
+            if not _profiler.tracing:
+                return jsonify(error="tracemalloc is not tracing"), 409
+            _profiler.snapshot(request.args["snapshot"])
+
+    report = {
+        "rss_bytes": rss_bytes(),
+        "tracing": _profiler.tracing,
+        "bots": {
+            "{}x{}".format(width, height): env_footprint(bot.env)
+            for (width, height), bot in list(_bots.items())
+        }
+    }
+    if _profiler.tracing:
+        current, peak = _profiler.traced()
+        report["traced_bytes"] = {"current": current, "peak": peak}
+        report["snapshots"] = _profiler.snapshot_names()
+        report["top"] = _profiler.top(limit, group_by)
+        if "diff" in request.args:
+            try:
+                report["diff"] = _profiler.diff(request.args["diff"],
+                                                request.args.get("against"),
+                                                limit, group_by)
+            except KeyError as e:
+                return jsonify(error="Unknown snapshot: {}".format(e.args[0])), 404
+    return jsonify(report)
+
+
+@server.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+def parse_size(size):
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--warmup",
+                        type=parse_size,
+                        action="append",
+                        default=[],
+                        metavar="WIDTHxHEIGHT",
+                        help="board size to prepare before opening the port, can be repeated")
+    args = parser.parse_args()
+
+    setup()
+    warm_up(args.warmup)
+    signal.signal(signal.SIGUSR1, save_snapshot)
+    signal.signal(signal.SIGTERM, save_snapshot)
     try:
-        server.run(host="0.0.0.0", port=9090)
+        server.run(host="0.0.0.0", port=args.port)
     finally:
         print("Save game frames and board before exiting ...")
-        env.save(".")
+        save_games(".")
         sys.exit(0)
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
+
 
 class Singleton(type):
     _instances = {}
@@ -9,3 +11,11 @@ class Singleton(type):
             cls._instances[cls] = super(Singleton,
                                         cls).__call__(*args, **kwargs)
         return cls._instances[cls]
+
+
+def replace_file(path, write):
+    """write into a temporary file then move it to path, so a reader never sees a partial file"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("wb") as f:
+        write(f)
+    os.replace(str(tmp_path), str(path))